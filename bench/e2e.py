@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+__doc__ = """Throughput of clone, fetch and push against the fake tf.
+
+Generates a synthetic TFS history in a temporary folder, then
+    clones the first --changesets changesets,
+    fetches --fetch more changesets added on the "server",
+    pushes --push local commits.
+Every command runs with --trace. The time spent in tf and git comes from the
+traces; the rest is git-tf itself. Needs nothing but git and Python."""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import subprocess as proc
+
+bench = os.path.dirname(os.path.abspath(__file__))
+gitTf = os.path.join(os.path.dirname(bench), 'git-tf')
+fakeTf = os.path.join(bench, 'faketf.py')
+
+
+class Repo(object):
+    """A fake TFS server, a mapped folder and git configuration isolated in a temporary folder."""
+
+    def __init__(self, root, args):
+        self.root = root
+        self.args = args
+        self.store = os.path.join(root, 'store')
+        self.folder = os.path.join(root, 'ws')
+        self.random = random.Random(args.seed)
+        self.files = []
+        self.env = dict(os.environ, HOME=root, FAKETF_STORE=self.store, FAKETF_LATENCY=str(args.latency),
+                        GIT_CONFIG_NOSYSTEM='1')
+        for name in ['GIT_DIR', 'GIT_WORK_TREE', 'GIT_INDEX_FILE', 'GIT_TF_TRACE']:
+            self.env.pop(name, None)
+        os.makedirs(self.store)
+        os.makedirs(self.folder)
+
+        tfCmd = '"%s" "%s"' % (sys.executable, fakeTf)
+        for name, value in [('tf.cmd', tfCmd), ('user.name', 'bench'), ('user.email', 'bench@example.com'),
+                            ('init.defaultBranch', 'master'), ('tf.clone.autocrlf', 'false')]:
+            self.run(['git', 'config', '--global', name, value])
+        self.server = {'root': '$/Proj', 'changesets': []}
+        self.saveServer()
+        self.run([sys.executable, fakeTf, 'workfold', '-map', '$/Proj', self.folder])
+
+    def run(self, argv, **kwargs):
+        return proc.run(argv, cwd=self.folder, env=self.env, check=True, stdout=proc.PIPE, stderr=proc.STDOUT,
+                        **kwargs).stdout.decode('utf-8', 'replace')
+
+    def content(self, seed):
+        line = 'line %d of a generated file\n' % seed
+        return line * max(self.args.fileSize // len(line), 1)
+
+    def changes(self, id):
+        """Returns {path: content or None} of a generated changeset."""
+        if not self.files:
+            self.files = ['dir%d/file%d.txt' % (i % 10, i) for i in range(self.args.files)]
+            return {path: self.content(i) for i, path in enumerate(self.files)}
+        changes = {}
+        for path in self.random.sample(self.files, min(self.args.changeSize, len(self.files))):
+            changes[path] = self.content(id)
+        if self.random.random() < 0.2:
+            path = 'dir%d/added%d.txt' % (id % 10, id)
+            self.files.append(path)
+            changes[path] = self.content(id)
+        if self.random.random() < 0.1 and len(self.files) > 1:
+            path = self.random.choice([f for f in self.files if f not in changes])
+            self.files.remove(path)
+            changes[path] = None
+        return changes
+
+    def addChangesets(self, count):
+        changesets = self.server['changesets']
+        for _ in range(count):
+            id = len(changesets) + 1
+            changesets.append({'id': id, 'committer': 'DOMAIN\\bench', 'date': '2012-01-01T10:00:00.000+0000',
+                               'comment': 'changeset %d' % id, 'changes': self.changes(id)})
+        self.saveServer()
+
+    def saveServer(self):
+        with open(os.path.join(self.store, 'server.json'), 'w') as f:
+            json.dump(self.server, f)
+
+    def commit(self, count):
+        for i in range(count):
+            tracked = self.run(['git', 'ls-files', '-z']).split('\0')[:-1]
+            for path in self.random.sample(tracked, min(self.args.changeSize, len(tracked))):
+                with open(os.path.join(self.folder, path), 'a') as f:
+                    f.write('local change %d\n' % i)
+            self.run(['git', 'commit', '-qam', 'local change %d' % i])
+
+    def gitTf(self, name, *args):
+        """Runs a git-tf command and returns its wall time and trace summary."""
+        trace = os.path.join(self.root, name + '.json')
+        started = time.perf_counter()
+        self.run([sys.executable, gitTf, name, '--trace', trace] + list(args))
+        elapsed = time.perf_counter() - started
+        with open(trace) as f:
+            events = json.load(f)['traceEvents']
+        times, calls = {'git': 0, 'tf': 0}, {'git': 0, 'tf': 0}
+        for event in events:
+            if event.get('cat') in times and not event['args']['persistent']:
+                times[event['cat']] += event['dur'] / 1e6
+                calls[event['cat']] += 1
+        return elapsed, times, calls
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('-c', '--changesets', type=int, default=200, help='changesets to clone')
+    parser.add_argument('-f', '--fetch', type=int, default=50, help='changesets to fetch after the clone')
+    parser.add_argument('-p', '--push', type=int, default=20, help='local commits to push')
+    parser.add_argument('--files', type=int, default=100, help='files in the first changeset')
+    parser.add_argument('--changeSize', type=int, default=5, help='files modified by each changeset')
+    parser.add_argument('--fileSize', type=int, default=2000, help='approximate file size in bytes')
+    parser.add_argument('--latency', type=float, default=0, help='seconds each tf command takes additionally')
+    parser.add_argument('--seed', type=int, default=1, help='random seed of the generated history')
+    parser.add_argument('--keep', action='store_true', help='keep the temporary folder')
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix='git-tf-bench-')
+    try:
+        repo = Repo(root, args)
+        print('{:<6} {:>6} {:>9} {:>8} {:>8} {:>8} {:>9} {:>9} {:>13}'.format(
+            'stage', 'count', 'seconds', 'per sec', 'tf s', 'git s', 'tf calls', 'git calls', 'git-tf ms/cs'))
+
+        def report(name, count, result):
+            elapsed, times, calls = result
+            own = max(elapsed - times['tf'] - times['git'], 0)
+            print('{:<6} {:>6} {:>9.2f} {:>8.1f} {:>8.2f} {:>8.2f} {:>9} {:>9} {:>13.1f}'.format(
+                name, count, elapsed, count / elapsed, times['tf'], times['git'], calls['tf'], calls['git'],
+                own * 1000 / max(count, 1)))
+
+        repo.addChangesets(args.changesets)
+        report('clone', args.changesets, repo.gitTf('clone', '--all', '-e', 'bench@example.com'))
+        if args.fetch:
+            repo.addChangesets(args.fetch)
+            report('fetch', args.fetch, repo.gitTf('fetch'))
+            repo.run(['git', 'checkout', '-q', 'master'])
+            repo.run(['git', 'merge', '-q', '--ff-only', 'tfs'])
+        if args.push:
+            repo.run(['git', 'checkout', '-q', 'master'])
+            repo.commit(args.push)
+            report('push', args.push, repo.gitTf('push'))
+    except proc.CalledProcessError as e:
+        print('Command %s failed:' % ' '.join(e.cmd))
+        print(e.stdout.decode('utf-8', 'replace'))
+        sys.exit(1)
+    finally:
+        if args.keep:
+            print('Kept', root)
+        else:
+            shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,380 @@
+#!/usr/bin/env python3
+__doc__ = """Fake Team Explorer Everywhere tf backed by a local changeset store.
+
+It lets git-tf run without a TFS server. Point tf.cmd config value to it:
+
+    $ git config tf.cmd "python3 /path/to/bench/faketf.py"
+    $ python3 bench/faketf.py workfold -map '$/Proj' /path/to/folder
+
+Supports workfold, history -format:xml, get -version:, status, checkout, add,
+rm, rename, undo, checkin and @commandfile.
+
+State lives in $FAKETF_STORE (default ./.faketf-store):
+    server.json     {"root": "$/Proj", "changesets": [{id, committer, date, comment, changes}]}
+    workspace.json  {"localRoot": ..., "version": N, "items": {path: version}, "pending": {path: change}}
+items are the versions of paths got by a get limited to them. Changes map paths to file contents, or to null for deleted files.
+
+Environment:
+    FAKETF_LATENCY          seconds every command sleeps, as a round trip to the server would take
+    FAKETF_FAIL_GET         changeset number that "get" fails to get
+    FAKETF_FAIL_COMMAND     command that always fails, e.g. checkin
+"""
+import json
+import os
+import shlex
+import stat
+import sys
+import time
+from xml.sax.saxutils import escape, quoteattr
+
+store = os.environ.get('FAKETF_STORE') or os.path.abspath('.faketf-store')
+latency = float(os.environ.get('FAKETF_LATENCY') or 0)
+
+
+def load(name, default):
+    try:
+        with open(os.path.join(store, name)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return default
+
+
+def save(name, data):
+    tmp = os.path.join(store, name + '.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp, os.path.join(store, name))
+
+
+server = load('server.json', {'root': '$/Proj', 'changesets': []})
+ws = load('workspace.json', {'localRoot': None, 'version': 0, 'pending': {}})
+
+
+def treeAt(version):
+    tree = {}
+    for cs in server['changesets']:
+        if cs['id'] > version:
+            break
+        for path, content in cs['changes'].items():
+            if content is None:
+                tree.pop(path, None)
+            else:
+                tree[path] = content
+    return tree
+
+
+def workspaceTree():
+    """Returns the files the workspace has, considering paths got at other versions."""
+    tree = treeAt(ws['version'])
+    for path, version in ws.get('items', {}).items():
+        content = treeAt(version).get(path)
+        if content is None:
+            tree.pop(path, None)
+        else:
+            tree[path] = content
+    return tree
+
+
+def rel(path):
+    root = ws['localRoot']
+    path = os.path.abspath(path)
+    if path == root:
+        return ''
+    if not path.startswith(root + os.sep):
+        fail('%s is not mapped' % path, 100)
+    return os.path.relpath(path, root).replace(os.sep, '/')
+
+
+def local(relPath):
+    return os.path.join(ws['localRoot'], *relPath.split('/'))
+
+
+def fail(msg, code=100):
+    print(msg, file=sys.stderr)
+    sys.exit(code)
+
+
+def setWritable(path, writable):
+    mode = os.stat(path).st_mode
+    os.chmod(path, mode | stat.S_IWRITE if writable else mode & ~stat.S_IWRITE & ~stat.S_IWGRP & ~stat.S_IWOTH)
+
+
+def writeFile(relPath, content):
+    path = local(relPath)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if os.path.exists(path):
+        os.chmod(path, os.stat(path).st_mode | stat.S_IWRITE)
+    with open(path, 'w', newline='') as f:
+        f.write(content)
+    setWritable(path, False)
+
+
+def removeEmptyDirs(relPath):
+    d = os.path.dirname(local(relPath))
+    while d != ws['localRoot'] and os.path.isdir(d) and not os.listdir(d):
+        os.rmdir(d)
+        d = os.path.dirname(d)
+
+
+def parseArgs(argv):
+    opts, paths = {}, []
+    for a in argv:
+        if a.startswith('-') and len(a) > 1:
+            k, _, v = a[1:].partition(':')
+            opts[k.lower()] = v
+        else:
+            paths.append(a)
+    return opts, paths
+
+
+def cmdWorkfold(opts, paths):
+    if 'map' in opts:
+        ws['localRoot'] = os.path.abspath(paths[1])
+        server['root'] = paths[0]
+        save('server.json', server)
+        return
+    print('=' * 79)
+    print('Workspace: fake (user)')
+    print('Server   : http://fake.example.com/')
+    print(' %s: %s' % (server['root'], ws['localRoot']))
+
+
+def cmdHistory(opts, paths):
+    changesets = server['changesets']
+    lo, hi = 1, changesets[-1]['id'] if changesets else 0
+    if opts.get('version'):
+        a, _, b = opts['version'].partition('~')
+        lo = int(a.lstrip('Cc'))
+        hi = int((b or a).lstrip('Cc'))
+    selected = [cs for cs in reversed(changesets) if lo <= cs['id'] <= hi]
+    if opts.get('stopafter'):
+        selected = selected[:int(opts['stopafter'])]
+    if not selected and opts.get('version'):
+        # like tf, which fails if a version range has no changesets
+        print('No history entries were found for the item and version combination specified.')
+        sys.exit(1)
+    out = ['<?xml version="1.0" encoding="utf-8"?>', '<history>']
+    for cs in selected:
+        out.append('<changeset id="%d" owner=%s committer=%s date="%s">' %
+                   (cs['id'], quoteattr(cs['committer']), quoteattr(cs['committer']), cs['date']))
+        out.append('<comment>%s</comment>' % escape(cs['comment']))
+        out.append('</changeset>')
+    out.append('</history>')
+    print('\n'.join(out))
+
+
+def cmdGet(opts, paths):
+    version = int(opts.get('version', 'C%d' % server['changesets'][-1]['id']).lstrip('Cc'))
+    if str(version) == os.environ.get('FAKETF_FAIL_GET'):
+        fail('TF30063: You are not authorized to access the server.', 100)
+    old, new = workspaceTree(), treeAt(version)
+    selected = set(old) | set(new)
+    prefixes = [rel(p) for p in paths]
+    if '' in prefixes or not prefixes:
+        ws['version'] = version
+        ws['items'] = {}
+    else:
+        selected = {p for p in selected if any(p == x or p.startswith(x + '/') for x in prefixes)}
+        for path in selected:
+            ws.setdefault('items', {})[path] = version
+    lines = []
+    for path in sorted(selected):
+        if path in ws['pending']:
+            continue
+        if path not in new:
+            p = local(path)
+            if os.path.exists(p):
+                os.chmod(p, os.stat(p).st_mode | stat.S_IWRITE)
+                os.remove(p)
+                removeEmptyDirs(path)
+            lines.append((os.path.dirname(p), 'Deleting ' + os.path.basename(p)))
+        elif old.get(path) != new[path] or not os.path.exists(local(path)):
+            p = local(path)
+            if os.path.exists(p) and os.stat(p).st_mode & stat.S_IWRITE:
+                fail('Conflict: %s - Unable to perform the get operation because it is writable' % p, 1)
+            verb = 'Replacing ' if path in old else 'Getting '
+            writeFile(path, new[path])
+            lines.append((os.path.dirname(p), verb + os.path.basename(p)))
+    if not lines:
+        print('All files up to date.')
+        return
+    lastDir = None
+    for d, line in lines:
+        if d != lastDir:
+            if lastDir is not None:
+                print()
+            print(d + ':')
+            lastDir = d
+        print(line)
+
+
+def cmdStatus(opts, paths):
+    pending = ws['pending']
+    if opts.get('format', '').lower() == 'xml':
+        print('<?xml version="1.0" encoding="utf-8"?>')
+        print('<status><pending-changes>')
+        for path, change in sorted(pending.items()):
+            source = ws.get('renames', {}).get(path)
+            source = ' source-item=%s' % quoteattr(server['root'] + '/' + source) if source else ''
+            print('<pending-change server-item=%s local-item=%s change-type=%s%s/>' %
+                  (quoteattr(server['root'] + '/' + path), quoteattr(local(path)), quoteattr(change), source))
+        print('</pending-changes><candidate-pending-changes/></status>')
+        return
+    if not pending:
+        print('There are no matching pending changes.')
+        return
+    print('File name Change Local path')
+    print('--------- ------ ----------')
+    for path, change in sorted(pending.items()):
+        print('%s %s %s' % (os.path.basename(path), change, local(path)))
+    print()
+    print('%d change(s)' % len(pending))
+
+
+def expand(paths, recursive):
+    result = []
+    tree = workspaceTree()
+    for p in paths:
+        r = rel(p)
+        if recursive:
+            prefix = r + '/' if r else ''
+            matched = [t for t in tree if t == r or t.startswith(prefix)]
+            result += matched or [r]
+        else:
+            result.append(r)
+    return result
+
+
+def cmdCheckout(opts, paths):
+    for r in expand(paths, 'recursive' in opts):
+        if not os.path.exists(local(r)):
+            fail('%s does not exist' % r)
+        if ws['pending'].get(r) not in ('add', 'rename', 'rename, edit'):
+            ws['pending'][r] = 'edit' if r not in ws['pending'] else ws['pending'][r]
+        setWritable(local(r), True)
+        print(r)
+
+
+def cmdAdd(opts, paths):
+    for r in expand(paths, False):
+        if not os.path.exists(local(r)):
+            fail('%s does not exist' % r)
+        ws['pending'][r] = 'add'
+        print(r)
+
+
+def cmdRm(opts, paths):
+    for r in expand(paths, 'recursive' in opts):
+        p = local(r)
+        if os.path.exists(p):
+            os.chmod(p, os.stat(p).st_mode | stat.S_IWRITE)
+            os.remove(p)
+        ws['pending'][r] = 'delete'
+        print(r)
+
+
+def cmdRename(opts, paths):
+    src, dest = rel(paths[0]), rel(paths[1])
+    if not os.path.exists(local(src)):
+        fail('%s does not exist' % src)
+    os.makedirs(os.path.dirname(local(dest)), exist_ok=True)
+    os.rename(local(src), local(dest))
+    ws['pending'][src] = 'delete'
+    ws['pending'][dest] = 'rename'
+    ws.setdefault('renames', {})[dest] = src
+    print(dest)
+
+
+def cmdUndo(opts, paths):
+    tree = workspaceTree()
+    targets = set(expand(paths, 'recursive' in opts))
+    if 'recursive' in opts:
+        prefixes = [rel(p) for p in paths]
+        targets |= {p for p in ws['pending'] if any(not x or p == x or p.startswith(x + '/') for x in prefixes)}
+    undone = 0
+    for r in sorted(targets):
+        change = ws['pending'].pop(r, None)
+        if change is None:
+            continue
+        undone += 1
+        ws.get('renames', {}).pop(r, None)
+        p = local(r)
+        if r in tree:
+            writeFile(r, tree[r])
+        elif os.path.exists(p):
+            os.chmod(p, os.stat(p).st_mode | stat.S_IWRITE)
+            os.remove(p)
+            removeEmptyDirs(r)
+        print('Undoing ' + r)
+    if not undone:
+        print('No pending changes were found for ' + ' '.join(paths))
+        sys.exit(100)
+
+
+def cmdCheckin(opts, paths):
+    if not ws['pending']:
+        print('There are no pending changes.')
+        sys.exit(1)
+    comment = opts.get('comment', '')
+    if comment.startswith('@'):
+        with open(comment[1:]) as f:
+            comment = f.read()
+    changes = {}
+    for path, change in ws['pending'].items():
+        if change == 'delete':
+            changes[path] = None
+        else:
+            with open(local(path), newline='') as f:
+                changes[path] = f.read()
+            setWritable(local(path), False)
+    newId = (server['changesets'][-1]['id'] if server['changesets'] else 0) + 1
+    server['changesets'].append({'id': newId, 'committer': 'DOMAIN\\user',
+                                 'date': time.strftime('%Y-%m-%dT%H:%M:%S.000+0000', time.gmtime()),
+                                 'comment': comment, 'changes': changes,
+                                 'workitems': opts.get('associate')})
+    save('server.json', server)
+    ws['pending'] = {}
+    ws['renames'] = {}
+    if ws['version'] == newId - 1 and not ws.get('items'):
+        ws['version'] = newId
+    else:
+        # the workspace was not at the latest version, so only the checked in paths are at newId
+        ws.setdefault('items', {}).update((path, newId) for path in changes)
+    print('Changeset #%d checked in.' % newId)
+
+
+commands = {
+    'workfold': cmdWorkfold, 'history': cmdHistory, 'get': cmdGet, 'status': cmdStatus,
+    'checkout': cmdCheckout, 'edit': cmdCheckout, 'add': cmdAdd, 'rm': cmdRm, 'delete': cmdRm,
+    'rename': cmdRename, 'undo': cmdUndo, 'checkin': cmdCheckin,
+}
+
+
+def runOne(argv):
+    opts, paths = parseArgs(argv[1:])
+    if argv[0] not in commands:
+        fail('Unknown command: ' + argv[0])
+    if latency:
+        time.sleep(latency)
+    if argv[0] == os.environ.get('FAKETF_FAIL_COMMAND'):
+        fail('TF10122: fake failure of ' + argv[0])
+    commands[argv[0]](opts, paths)
+
+
+def main(argv):
+    if not argv:
+        fail('Usage: tf <command>')
+    try:
+        if argv[0].startswith('@'):
+            with open(argv[0][1:]) as f:
+                for line in f:
+                    if line.strip():
+                        runOne(shlex.split(line))
+        else:
+            runOne(argv)
+    finally:
+        save('workspace.json', ws)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+__doc__ = """Per-command latency of trivial git calls made through core.Runner.
+
+Compares the selector-based Process with the old reader that polled the
+child and slept 50 ms whenever stdout had nothing to offer."""
+
+import os
+import sys
+import time
+import argparse
+import subprocess as proc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from core import git
+
+
+def pollingCall(argv):
+    pipe = proc.Popen(argv, stdout=proc.PIPE, stderr=proc.PIPE)
+    lines = []
+    while True:
+        line = pipe.stdout.readline()
+        if line != b'':
+            lines.append(line.decode('utf-8')[:-1])
+        elif pipe.poll() is not None:
+            break
+        else:
+            time.sleep(0.05)
+    return '\n'.join(lines)
+
+
+def measure(call, count):
+    timings = []
+    for _ in range(count):
+        started = time.perf_counter()
+        call()
+        timings.append(time.perf_counter() - started)
+    timings.sort()
+    return timings
+
+
+def report(name, timings):
+    ms = lambda t: '%7.2f' % (t * 1000)
+    print('{:<12} mean {} ms   p50 {} ms   p95 {} ms   max {} ms'.format(
+        name, ms(sum(timings) / len(timings)), ms(timings[len(timings) // 2]),
+        ms(timings[int(len(timings) * 0.95)]), ms(timings[-1])))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('-n', '--count', type=int, default=100, help='calls per command')
+    args = parser.parse_args()
+
+    for cmd in ['--version', 'rev-parse --git-dir', 'config --get core.bare']:
+        print('$ git ' + cmd)
+        report('polling', measure(lambda: pollingCall(git.genArgv(cmd)), args.count))
+        report('selector', measure(lambda: git(cmd, errorValue=''), args.count))
+        print()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+__doc__ = """Startup overhead of git-tf commands.
+
+Runs each command several times and subtracts the time of a bare interpreter,
+so the result is what git-tf itself costs before and around its git calls.
+Run it inside a git-tf repository to include "status", which is meant to stay
+under the budget."""
+
+import os
+import sys
+import time
+import argparse
+import subprocess as proc
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+gitTf = os.path.join(root, 'git-tf')
+
+
+def measure(argv, count):
+    timings = []
+    for _ in range(count):
+        started = time.perf_counter()
+        proc.call(argv, stdout=proc.DEVNULL, stderr=proc.DEVNULL)
+        timings.append(time.perf_counter() - started)
+    timings.sort()
+    return timings[len(timings) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('-n', '--count', type=int, default=20, help='runs per command')
+    parser.add_argument('-b', '--budget', type=float, default=50, help='allowed overhead in ms')
+    args = parser.parse_args()
+
+    python = [sys.executable]
+    baseline = measure(python + ['-c', 'pass'], args.count)
+    print('{:<28} {:7.1f} ms'.format('python -c pass', baseline * 1000))
+
+    inRepo = proc.call(['git', 'rev-parse', '--verify', '-q', 'tfs'], stdout=proc.DEVNULL, stderr=proc.DEVNULL) == 0
+    cases = [
+        ('import core', python + ['-c', 'import sys; sys.path.insert(0, %r); import core' % root]),
+        ('git tf --help', python + [gitTf, '--help']),
+        ('git tf status --help', python + [gitTf, 'status', '--help']),
+    ]
+    if inRepo:
+        cases.append(('git tf status', python + [gitTf, 'status']))
+
+    overBudget = False
+    for name, argv in cases:
+        overhead = (measure(argv, args.count) - baseline) * 1000
+        overBudget |= name == 'git tf status' and overhead > args.budget
+        print('{:<28} {:7.1f} ms over the interpreter'.format(name, overhead))
+    if not inRepo:
+        print('Not in a git-tf repository, "git tf status" was skipped')
+    sys.exit(1 if overBudget else 0)
+
+if __name__ == '__main__':
+    main()
@@ -2,15 +2,93 @@
 from core import *
 from fetch import fetch
 import shutil
+import json
 
 emailRgx = r'\b[A-Z0-9._%+-]+@[A-Z0-9.-]+\.[A-Z]{2,4}\b'
 
 
+class Checkpoint(object):
+    """Lets an interrupted clone resume without requesting the TFS history again.
+
+    .git/tf-clone has a header with the requested changeset range, then the changesets
+    as they arrive from tf history, then an end mark once the history is complete.
+    The last committed changeset is the one noted on tfs branch.
+    """
+
+    def __init__(self):
+        self._file = None
+
+    def _path(self):
+        return os.path.join('.git', 'tf-clone')
+
+    def exists(self):
+        return os.path.exists(self._path())
+
+    def _write(self, item):
+        self._file.write(json.dumps(item) + '\n')
+        self._file.flush()
+
+    def start(self, first, last):
+        self._file = open(self._path(), 'w')
+        self._write({'first': first and int(first), 'last': last and int(last)})
+
+    def record(self, history):
+        """Saves changesets while they pass through."""
+        if isinstance(history, list):
+            for cs in history:
+                self._write(cs.record())
+            self._write({'complete': True})
+            return history
+        return self._recordStream(history)
+
+    def _recordStream(self, history):
+        for cs in history:
+            self._write(cs.record())
+            yield cs
+        self._write({'complete': True})
+
+    def resume(self, cursor):
+        """Returns the changesets after cursor and their range, or None if nothing was saved."""
+        records = []
+        with open(self._path()) as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    # the line was being written when the clone was interrupted
+                    break
+        if not records:
+            return None
+        header = records.pop(0)
+        complete = bool(records) and records[-1] == {'complete': True}
+        if complete:
+            records.pop()
+
+        cursor = int(cursor)
+        saved = [tf.Changeset.fromRecord(r) for r in records]
+        history = [cs for cs in saved if int(cs.id) > cursor]
+        print('Last fetched changeset: %s. %d saved changeset(s) left to fetch' % (cursor or 'none', len(history)))
+
+        self._file = open(self._path(), 'a')
+        if not complete:
+            first = int(saved[-1].id) + 1 if saved else header['first']
+            print('Requesting the rest of the TFS history since', first)
+            history = chain(history, self._recordStream(tf.historyAscending(first, header['last'])))
+        return history, header['last'] and (max(cursor + 1, header['first']), header['last'])
+
+    def remove(self):
+        if self._file:
+            self._file.close()
+        if os.path.exists(self._path()):
+            os.remove(self._path())
+
+
 class clone(Command):
-    """Clone a TFS repository."""
+    """Clone a TFS repository. Run it again to resume an interrupted clone."""
 
     def __init__(self):
         self.fetch = fetch()
+        self.checkpoint = Checkpoint()
         Command.__init__(self)
 
     def _initArgParser(self, parser):
@@ -28,7 +106,7 @@ class clone(Command):
             help='email for TFS')
 
     def _checkRepositoryExists(self):
-        if git('status -s', errorValue='', allowedExitCodes=[1]):
+        if os.path.exists('.git'):
             print('A Git repository already exists')
             if git.getChangesetNumber():
                 print('If you tried to clone but it failed, try to continue by calling pull or fetch')
@@ -57,67 +135,90 @@ class clone(Command):
         email = self.args.email
         if email:
             checkEmail(email)
-            git('config user.email ' + email)
-            git('config user.name ' + email.split('@', 1)[0])
+            config.set('user.email', email)
+            config.set('user.name', email.split('@', 1)[0])
         else:
-            email = git('config user.email', errorMsg='Email is not specified')
+            email = config.get('user.email')
+            if not email:
+                fail('Email is not specified')
             checkEmail(email)
             if self.args.verbose:
                 print('Email is not specified, so using ', email)
 
     def _configure(self):
-        autocrlf = git('config tf.clone.autocrlf') or 'true'
-        git('config core.autocrlf ' + autocrlf)
+        config.set('core.autocrlf', config.get('tf.clone.autocrlf') or 'true')
 
         # rewrite all tf* notes on rebase, namely tf.wi
-        git('config notes.rewrite.rebase true')
-        git('config notes.rewriteRef refs/notes/tf*')
+        config.set('notes.rewrite.rebase', 'true')
+        config.set('notes.rewriteRef', 'refs/notes/tf*')
 
     def _setupBranches(self):
         git('commit --allow-empty -m root-commit')
         git('branch -f tfs')
-        git('branch --set-upstream master tfs')
+        git('branch --set-upstream-to=tfs master')
         git('checkout tfs')
 
     def _determineHistoryToFetch(self):
+        """Returns changesets to fetch and their range, if it is known."""
         # History
         if self.args.all:
             print('Requesting for the entire TFS history...')
-            return tf.history()
+            latest = tf.latestChangesetId()
+            return (tf.historyAscending(1, latest), (1, latest)) if latest else ([], None)
         elif self.args.number:
             print('Requesting for TFS history...')
-            return tf.history(stopAfter=self.args.number)
+            return list(tf.history(stopAfter=self.args.number))[::-1], None
         else:
             print('Determining the latest version...')
-            history = tf.history(stopAfter=1)
-            if not history:
-                return history
-            latest = history[0]
+            latest = tf.latestChangeset()
+            if not latest:
+                return [], None
             version = self.args.version
             if version:
                 print('Requesting for TFS history since', version)
-                return tf.history(version=(version, latest.id))
+                return tf.historyAscending(version, latest.id), (int(version), int(latest.id))
             else:
                 print('Version is not specified, so using the latest version...')
-                return [latest]
+                return [latest], None
 
-    def _fetch(self):
-        history = self._determineHistoryToFetch()
-        if not history:
-            print('Nothing to fetch')
-            return
-        history.reverse()
+    def _fetch(self, resumeFrom=None):
+        resumed = resumeFrom is not None and self.checkpoint.resume(resumeFrom)
+        if resumed:
+            history, idRange = resumed
+        else:
+            history, idRange = self._determineHistoryToFetch()
+            self.checkpoint.start(*(idRange or (None, None)))
+            history = self.checkpoint.record(history)
 
         # Fetch
         try:
             self.args.force = True
             self.fetch.args = self.args
-            self.fetch.doFetch(history)
+            if not self.fetch.doImport(history, idRange):
+                print('Nothing to fetch')
+            self.checkpoint.remove()
         finally:
             git('checkout master')
             git('reset --hard tfs')
 
+    def _resume(self):
+        print('Resuming the interrupted clone')
+        self._setupEmail()
+        config.flush()
+        git('checkout -q tfs')
+        # a killed import leaves the index behind tfs and the files tf got after the last checkpoint
+        git('reset -q')
+        if git('status -s'):
+            self.fetch.rollback()
+        self._fetch(resumeFrom=git.getChangesetNumber('tfs') or 0)
+
     def _run(self):
+        if self.checkpoint.exists():
+            self._resume()
+            print()
+            print('Cloning is completed. Try "git tf log" to see the change history.')
+            return
+
         self._checkRepositoryExists()
         self._checkDirectory()
         self.checkStatus(checkGit=False)
@@ -126,11 +227,14 @@ class clone(Command):
         try:
             self._configure()
             self._setupEmail()
+            config.flush()
             self._setupBranches()
             self._fetch()
         except:
-            if git('notes show', errorValue=False) is False:
+            if git.getChangesetNumber() is None and not self.checkpoint.exists():
                 shutil.rmtree('.git')
+            elif self.checkpoint.exists():
+                print('Run "git tf clone" again to resume cloning')
             raise
 
         print()
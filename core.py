@@ -1,14 +1,27 @@
 import subprocess as proc
 import os
+import shlex
+import atexit
 import stat
 import datetime
 import re
 import argparse
 import time
+import selectors
+import threading
+from collections import deque
 import locale
 import sys
+import shutil
+import contextlib
+import abc
+import bisect
 from itertools import *
-import xml.etree.ElementTree as etree
+try:
+    import fcntl
+except ImportError:
+    # Windows: a notes journal is recovered even if its writer is still running
+    fcntl = None
 
 os.environ['GIT_NOTES_REF'] = 'refs/notes/tf'
 locale.setlocale(locale.LC_ALL, '')
@@ -26,11 +39,25 @@ def fail(msg=None):
 _curCommand = None
 
 
+class Argv(str):
+    """Arguments that are passed to a command as they are, without formatting and splitting.
+
+    As a string, it is the quoted command line, e.g. for printing.
+    """
+
+    def __new__(cls, words):
+        argv = str.__new__(cls, ' '.join(map(shlex.quote, words)))
+        argv.words = list(words)
+        return argv
+
+
 class Runner:
     prefix = ''
+    name = 'run'
+    notFoundMsg = None
 
     def argsToStr(self, args):
-        if type(args) == str:
+        if type(args) == str or isinstance(args, Argv):
             return args
         elif type(args) in (tuple, list):
             fmt, *args = args
@@ -45,60 +72,80 @@ class Runner:
         if args:
             args = self.argsToStr(args).strip()
             if args:
-                cmd += ' ' + args
+                cmd = (cmd and cmd + ' ') + args
         return cmd
 
-    def start(self, args):
-        class Process:
-            def __init__(self, pipe):
-                self.pipe = pipe
-
-            def readline(self):
-                while True:
-                    line = self.pipe.stdout.readline()
-                    if line != b'':
-                        return line.decode('utf-8')[:-1]
-                    elif self.pipe.poll() is not None:
-                        return None
-                    else:
-                        time.sleep(0.05)
-
-            def poll(self):
-                return self.pipe.poll()
-
-            @property
-            def exitCode(self):
-                return self.pipe.returncode
-
-            def fail(self, lastMsg=None):
-                errorOutput = self.pipe.stderr.read(-1).decode('utf-8').strip()
-                if errorOutput:
-                    print(errorOutput)
-                print('Command "%s" exited with code %s' % (cmd, self.poll()))
-                if lastMsg:
-                    print(lastMsg)
-                fail()
-
-        cmd = (self.prefix and self.prefix + ' ') + self.argsToStr(args)
-        return Process(proc.Popen(cmd, shell=True, stderr=proc.PIPE, stdout=proc.PIPE))
-
-    def __call__(self, args, allowedExitCodes=[0], errorValue=None, output=False, indent=1, dryRun=None, errorMsg=None):
+    def traceLabel(self, args):
+        """Returns the name commands are grouped by in a trace, e.g. "git cat-file"."""
+        words = [w for w in self.argsToStr(args).split() if not w.startswith('-')]
+        return ' '.join([self.name] + words[:1])
+
+    def genArgv(self, args):
+        if isinstance(args, Argv):
+            return shlex.split(self.prefix) + args.words
+        # no intermediate shell: the command line is split the way /bin/sh would split it
+        cmd = self.genCommand(args)
+        return cmd if os.name == 'nt' else shlex.split(cmd)
+
+    def _start(self, args, input, env, separator):
+        cmd = self.genCommand(args)
+        pipe = proc.Popen(self.genArgv(args), stderr=proc.PIPE, stdout=proc.PIPE,
+                          stdin=proc.PIPE if input is not None else proc.DEVNULL,
+                          env=dict(os.environ, **env) if env else None)
+        process = Process(pipe, cmd, input, separator)
+        if tracer.enabled:
+            process.trace = (self.name, self.traceLabel(args))
+        return process
+
+    def _failNotFound(self, args, error, errorMsg=None):
+        print('Could not run "%s": %s' % (self.genCommand(args), error.strerror))
+        fail(errorMsg or self.notFoundMsg)
+
+    def start(self, args, input=None, env=None, separator=b'\n', errorMsg=None):
+        """Starts a command and returns its Process. Fails if the command cannot be run."""
+        try:
+            return self._start(args, input, env, separator)
+        except OSError as e:
+            self._failNotFound(args, e, errorMsg)
+
+    def stream(self, args, allowedExitCodes=[0], errorMsg=None, input=None, separator=b'\n'):
+        """Yields output lines, or records ending with separator, while the command is still running."""
+        args = self.argsToStr(args)
+        if _curCommand and _curCommand.args.verbose > 1:
+            print('$ ' + self.genCommand(args))
+
+        process = self.start(args, input, separator=separator, errorMsg=errorMsg)
+        try:
+            for line in process:
+                yield line
+        finally:
+            process.close()
+        if process.exitCode not in allowedExitCodes:
+            process.fail(errorMsg)
+
+    def __call__(self, args, allowedExitCodes=[0], errorValue=None, output=False, indent=1, dryRun=None, errorMsg=None,
+                 input=None, env=None):
         verbose = _curCommand and _curCommand.args.verbose > 1
 
         args = self.argsToStr(args)
         if verbose:
-            print('$ ' + (self.prefix and self.prefix + ' ') + args)
+            print('$ ' + self.genCommand(args))
         if dryRun:
             return dryRun
 
-        process = self.start(args)
-
-        result = ''
-        for line in iter(process.readline, None):
+        try:
+            process = self._start(args, input, env, b'\n')
+        except OSError as e:
+            if errorValue is not None:
+                return errorValue
+            self._failNotFound(args, e, errorMsg)
+
+        result = []
+        for line in process:
             if output or verbose:
                 print('  ' * indent + line)
-            result = result and result + '\n'
-            result += line
+            result.append(line)
+        result = '\n'.join(result)
 
         if process.exitCode in allowedExitCodes:
             return result
@@ -107,6 +154,213 @@ class Runner:
         else:
             process.fail(errorMsg)
 
+
+class Process(object):
+    """A running command. Streams stdout line by line while collecting stderr.
+
+    Both pipes (and stdin, if there is input) are serviced from a single selector loop,
+    so a child that writes a lot to stderr never blocks on a full pipe.
+    """
+    chunkSize = 65536
+    trace = None
+
+    def __init__(self, pipe, cmd, input=None, separator=b'\n'):
+        self.pipe = pipe
+        self.cmd = cmd
+        self.started = time.time()
+        self.outputBytes = 0
+        self._separator = separator
+        self._lines = deque()
+        self._partial = b''
+        self._stdoutOpen = True
+        self._finished = False
+        self._stderr = []
+        self._input = memoryview(input.encode('utf-8') if isinstance(input, str) else input or b'')
+        if os.name == 'nt':
+            self._startThreads()
+        else:
+            self._selector = selectors.DefaultSelector()
+            for stream, event in ((pipe.stdout, selectors.EVENT_READ), (pipe.stderr, selectors.EVENT_READ),
+                                  (pipe.stdin, selectors.EVENT_WRITE)):
+                if stream:
+                    os.set_blocking(stream.fileno(), False)
+                    self._selector.register(stream, event)
+
+    def _startThreads(self):
+        # selectors do not support pipes on Windows
+        def feedStdin():
+            self.pipe.stdin.write(self._input)
+            self.pipe.stdin.close()
+
+        self._selector = None
+        self._threads = [threading.Thread(target=lambda: self._stderr.append(self.pipe.stderr.read()), daemon=True)]
+        if self.pipe.stdin:
+            self._threads.append(threading.Thread(target=feedStdin, daemon=True))
+        for t in self._threads:
+            t.start()
+
+    def _pump(self):
+        """Blocks until some pipe is ready and services it."""
+        if not self._selector:
+            self._addStdout(self.pipe.stdout.read1(self.chunkSize))
+            return
+
+        for key, _ in self._selector.select():
+            stream = key.fileobj
+            if stream is self.pipe.stdin:
+                try:
+                    written = os.write(stream.fileno(), self._input[:self.chunkSize])
+                except BrokenPipeError:
+                    written = len(self._input)
+                self._input = self._input[written:]
+                if not self._input:
+                    self._selector.unregister(stream)
+                    stream.close()
+                continue
+
+            data = os.read(stream.fileno(), self.chunkSize)
+            if not data:
+                self._selector.unregister(stream)
+            if stream is self.pipe.stderr:
+                self._stderr.append(data)
+            else:
+                self._addStdout(data)
+
+    def _addStdout(self, data):
+        self.outputBytes += len(data)
+        if not data:
+            self._stdoutOpen = False
+            if self._partial:
+                self._lines.append(self._partial)
+                self._partial = b''
+            return
+        lines = (self._partial + data).split(self._separator)
+        self._partial = lines.pop()
+        self._lines.extend(lines)
+
+    def readline(self):
+        """Returns the next line of stdout without the separator, or None when the output is over."""
+        while not self._lines:
+            if not self._stdoutOpen:
+                self._finish()
+                return None
+            self._pump()
+        return self._lines.popleft().decode('utf-8')
+
+    def __iter__(self):
+        return iter(self.readline, None)
+
+    def _finish(self):
+        if self._finished:
+            return
+        if self._selector:
+            while self._selector.get_map():
+                self._pump()
+            self._selector.close()
+        else:
+            while self._stdoutOpen:
+                self._pump()
+            for t in self._threads:
+                t.join()
+        self.pipe.wait()
+        self._finished = True
+        if self.trace:
+            tracer.command(*self.trace, self.cmd, self.started, self.exitCode, self.outputBytes)
+
+    def close(self):
+        """Kills the command if it is still running."""
+        if not self._finished and self.pipe.poll() is None:
+            self.pipe.kill()
+        self._finish()
+
+    def poll(self):
+        return self.pipe.poll()
+
+    @property
+    def exitCode(self):
+        return self.pipe.returncode
+
+    @property
+    def errorOutput(self):
+        self._finish()
+        return b''.join(self._stderr).decode('utf-8', 'replace').strip()
+
+    def fail(self, lastMsg=None):
+        errorOutput = self.errorOutput
+        if errorOutput:
+            print(errorOutput)
+        print('Command "%s" exited with code %s' % (self.cmd, self.poll()))
+        if lastMsg:
+            print(lastMsg)
+        fail()
+
+
+class PersistentProcess(object):
+    """A long-lived process that answers requests written to its stdin."""
+
+    def __init__(self, argv, trace=None, cwd=None):
+        self.argv = argv
+        self.trace = trace
+        self.cwd = cwd
+        self.pipe = None
+
+    @property
+    def alive(self):
+        return self.pipe is not None and self.pipe.poll() is None
+
+    def _ensureStarted(self):
+        if not self.alive:
+            self.pipe = proc.Popen(self.argv, stdin=proc.PIPE, stdout=proc.PIPE, cwd=self.cwd)
+            self.started = time.time()
+            self.outputBytes = 0
+
+    def write(self, data):
+        self._ensureStarted()
+        try:
+            self.pipe.stdin.write(data.encode('utf-8') if isinstance(data, str) else data)
+            self.pipe.stdin.flush()
+        except BrokenPipeError:
+            self.fail()
+
+    def readline(self):
+        line = self.pipe.stdout.readline()
+        if not line:
+            self.fail()
+        self.outputBytes += len(line)
+        return line.decode('utf-8').rstrip('\n')
+
+    def expect(self, response):
+        line = self.readline()
+        if line != response:
+            self.fail('Expected "%s", got "%s"' % (response, line))
+
+    def close(self):
+        """Closes stdin, waits for the process to exit and returns its exit code."""
+        exitCode = None
+        if self.alive:
+            self.pipe.stdin.close()
+            exitCode = self.pipe.wait()
+            if self.trace and tracer.enabled:
+                # the whole lifetime of the process is one trace event
+                tracer.command(*self.trace, ' '.join(self.argv), self.started, exitCode,
+                               self.outputBytes, persistent=True)
+        self.pipe = None
+        return exitCode
+
+    def kill(self):
+        if self.alive:
+            self.pipe.kill()
+            self.pipe.wait()
+        self.pipe = None
+
+    def fail(self, msg=None):
+        if self.pipe.poll() is None:
+            self.pipe.kill()
+        self.pipe.wait()
+        print('Command "%s" exited with code %s' % (' '.join(self.argv), self.pipe.returncode))
+        self.pipe = None
+        fail(msg)
+
 run = Runner()
 
 #######      GIT       #######
@@ -114,50 +368,712 @@ run = Runner()
 
 class _git(Runner):
     prefix = 'git'
+    name = 'git'
+    notFoundMsg = 'Git not found in the $PATH variable'
+
+    def __init__(self):
+        self._batches = {}
+
+    def batch(self, args):
+        """Returns a persistent git process, one per command and working directory."""
+        key = (args, os.getcwd())
+        process = self._batches.get(key)
+        if not process:
+            process = self._batches[key] = PersistentProcess(self.genArgv(args),
+                                                             (self.name, self.traceLabel(args)))
+        return process
+
+    def gitPath(self, name):
+        """Returns an absolute path of a file inside the .git directory."""
+        return os.path.join(self('rev-parse --absolute-git-dir'), name)
+
+    def close(self):
+        for process in self._batches.values():
+            process.close()
+        self._batches.clear()
+
+    def resolve(self, rev):
+        """Returns the full hash of a commit or None if rev does not name a commit."""
+        batch = self.batch('cat-file --batch-check')
+        batch.write(rev + '^{commit}\n')
+        header = batch.readline().split()
+        return header[0] if len(header) == 3 else None
+
+    def catFiles(self, objects):
+        """Yields (object, text) pairs for text objects, such as notes, using a single cat-file run."""
+        lines = self.stream('cat-file --batch', input=''.join(o + '\n' for o in objects))
+        for header in lines:
+            obj, *rest = header.split()
+            if rest == ['missing']:
+                yield obj, None
+                continue
+            # the object is followed by a newline
+            left = int(rest[1]) + 1
+            content = []
+            while left > 0:
+                line = next(lines)
+                content.append(line)
+                left -= len(line.encode('utf-8')) + 1
+            yield obj, '\n'.join(content).rstrip('\n')
+
+    def hashObjects(self, paths):
+        """Writes files to the object database and returns their hashes."""
+        batch = self.batch('hash-object -w --stdin-paths')
+        hashes = []
+        for path in paths:
+            if os.path.islink(path):
+                # git stores the target of a symbolic link, as update-index does
+                hashes.append(self('hash-object -w --stdin', input=os.readlink(path)))
+                continue
+            batch.write(path + '\n')
+            hashes.append(batch.readline())
+        return hashes
+
+    def writeTree(self, **kwargs):
+        return self('write-tree', **kwargs)
+
+    def commitTree(self, tree, parents, message, author=None, date=None):
+        env = {}
+        if author:
+            env['GIT_AUTHOR_NAME'], env['GIT_AUTHOR_EMAIL'] = author
+        if date:
+            env['GIT_AUTHOR_DATE'] = date
+        parents = ''.join(' -p ' + p for p in parents)
+        if not message.endswith('\n'):
+            message += '\n'
+        return self('commit-tree %s%s -F -' % (tree, parents), input=message, env=env)
+
+    def updateRefs(self, updates):
+        """Atomically updates (ref, newValue, oldValue) triples."""
+        batch = self.batch('update-ref --stdin')
+        batch.write('start\n')
+        batch.expect('start: ok')
+        for ref, new, old in updates:
+            batch.write('update %s %s %s\n' % (ref, new, old or ''))
+        batch.write('commit\n')
+        batch.expect('commit: ok')
+
+    def updateIndex(self, paths, **kwargs):
+        """Stages paths: adds new and modified files, removes deleted ones."""
+        if paths:
+            self('update-index --add --remove -z --stdin', input=''.join(p + '\0' for p in paths), **kwargs)
+
+    def restore(self, paths, removeUntracked=True):
+        """Resets the index to HEAD and makes the given files and folders of the worktree match HEAD.
+
+        Nothing else in the worktree is touched. Paths that are not in HEAD are removed unless
+        removeUntracked is False. Returns the restored files.
+        """
+        self('reset -q')
+        tracked = splitNul(self('ls-files -z'))
+        restored = set()
+        for path in set(paths):
+            i = bisect.bisect_left(tracked, path)
+            matched = False
+            while i < len(tracked) and tracked[i].startswith(path):
+                if tracked[i] == path or tracked[i].startswith(path + '/'):
+                    restored.add(tracked[i])
+                    matched = True
+                i += 1
+            if matched or not removeUntracked or not os.path.lexists(path):
+                continue
+            removePath(path)
+        restored = sorted(restored)
+        if restored:
+            self('checkout-index -f -z --stdin', input=''.join(p + '\0' for p in restored))
+        return restored
+
+    def diffChanges(self, revs, renameLimit=None):
+        """Returns FileChange objects between revs in a single diff.
+
+        Copies are searched among all files, unless renameLimit is set. Then only modified files are
+        considered as copy sources, and at most renameLimit files take part in rename detection.
+        """
+        copies = '-C -l%d' % renameLimit if renameLimit else '--find-copies-harder'
+        items = splitNul(self('diff --raw -z --no-abbrev %s %s' % (copies, revs)))
+        changes = []
+        i = 0
+        while i < len(items):
+            # ":oldMode newMode oldHash newHash status" is followed by one path, or two for renames and copies
+            _, mode, _, hash, status = items[i].split()
+            pathCount = 2 if status[0] in 'RC' else 1
+            changes.append(FileChange(status, items[i + 1:i + 1 + pathCount], mode, hash))
+            i += 1 + pathCount
+        return changes
 
     def hasChanges(self):
         return self('status -s')
 
     def getChangesetNumber(self, commit='', fail=False):
-        note = git('notes show ' + commit, errorValue='')
-        return re.findall(r'^\d+', note, re.M)[-1] if note else self.failNoLastChangeset() if fail else None
+        number = changesetIndex.changeset(commit or 'HEAD')
+        return number if number else self.failNoLastChangeset() if fail else None
 
     def failNoLastChangeset(self):
         fail('The last synchronized changeset could not determined. Probably the last commit is missing a tf note. Commit: %s' %
                  git('log -1 --format=%H tfs'))
 
 git = _git()
-try:
-    git('--version', errorMsg='Git not found in the $PATH variable')
-except GitTfException:
-    exit(1)
+atexit.register(git.close)
+
+
+class Config(object):
+    """git config values. They are read with a single git config call and cached.
+
+    set() only collects values, flush() writes them and drops the cache.
+    """
+
+    def __init__(self):
+        self._values = None
+        self._pending = {}
+
+    @staticmethod
+    def _key(name):
+        # section and variable names are case-insensitive, subsections are not
+        parts = name.split('.')
+        parts[0], parts[-1] = parts[0].lower(), parts[-1].lower()
+        return '.'.join(parts)
+
+    def _load(self):
+        # other threads may read the values, so they are replaced at once
+        values = {}
+        for item in git('config -z --list', errorValue='').split('\0'):
+            key, _, value = item.partition('\n')
+            if key:
+                values[key] = value
+        self._values = values
+        return values
+
+    def get(self, name, default=None):
+        """Returns a value as a string or default if it is not set."""
+        key = self._key(name)
+        if key in self._pending:
+            return self._pending[key]
+        values = self._values
+        if values is None:
+            values = self._load()
+        return values.get(key, default)
+
+    def getInt(self, name, default=None):
+        value = self.get(name)
+        if value is None:
+            return default
+        try:
+            return int(value)
+        except ValueError:
+            fail('Config value %s must be a number: %s' % (name, value))
+
+    def invalidate(self):
+        """Drops the cached values, so they are read again."""
+        self._values = None
+
+    def set(self, name, value):
+        """Sets a value in the repository config. It is written by flush()."""
+        self._pending[self._key(name)] = str(value)
+
+    def flush(self):
+        if not self._pending:
+            return
+        for key, value in self._pending.items():
+            git(Argv(['config', key, value]))
+        self._pending.clear()
+        self.invalidate()
+
+config = Config()
+
+
+class FileChange(object):
+    """A file change reported by git diff --raw. mode and hash describe the file after the change."""
+    __slots__ = ('status', 'kind', 'paths', 'mode', 'hash')
+
+    kinds = {'A': 'add', 'M': 'modify', 'D': 'delete', 'R': 'rename', 'C': 'copy'}
+
+    def __init__(self, status, paths, mode=None, hash=None):
+        self.status = status
+        self.kind = self.kinds.get(status[0], 'unknown')
+        self.paths = paths
+        self.mode = mode
+        self.hash = hash
+
+    @property
+    def path(self):
+        """The path after the change."""
+        return self.paths[-1]
+
+    def __str__(self):
+        text = ' -> '.join(self.paths)
+        return text if self.kind != 'unknown' else '%s %s' % (self.status, text)
+
+
+
+class NotesBatch(object):
+    """Collects notes and writes them to a notes ref as a single commit.
+
+    The commit is made by git fast-import, which also keeps git's fanout layout of the notes tree.
+    Every note is appended to a journal in .git first, so the notes of an interrupted run
+    can be recovered. A note with None text is removed.
+
+    Writers hold a shared lock on the journal. It is recovered only by a process that gets
+    the exclusive lock, i.e. when no process that wrote it is running.
+    """
+
+    def __init__(self, ref):
+        self.ref = ref
+        self.pending = {}
+        self._journal = None
+        self._journalPath = None
+
+    def journalPath(self):
+        if self._journalPath is None:
+            self._journalPath = git.gitPath('notes-%s.journal' % self.ref.rsplit('/', 1)[-1])
+        return self._journalPath
+
+    def _lock(self, exclusive):
+        """Locks the open journal. Returns False if exclusive and another process has it locked."""
+        if fcntl is None:
+            return True
+        try:
+            fcntl.flock(self._journal, fcntl.LOCK_EX | fcntl.LOCK_NB if exclusive else fcntl.LOCK_SH)
+            return True
+        except BlockingIOError:
+            return False
+
+    def _open(self, exclusive=False):
+        """Opens and locks the journal. Returns False if exclusive and another process has it open."""
+        while True:
+            self._journal = open(self.journalPath(), 'a')
+            if not self._lock(exclusive):
+                self._close()
+                return False
+            # the journal may have been removed by a flush while this process waited for the lock
+            try:
+                if os.path.samestat(os.fstat(self._journal.fileno()), os.stat(self.journalPath())):
+                    return True
+            except FileNotFoundError:
+                pass
+            self._close()
+
+    def _close(self):
+        self._journal.close()
+        self._journal = None
+
+    def add(self, commit, text):
+        if self._journal is None:
+            self._open()
+        self._journal.write(commit + ('' if text is None else ' ' + text) + '\n')
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+        self.pending[commit] = text
+
+    def flush(self, message='Notes added by git-tf'):
+        if self.pending:
+            stream = []
+
+            def data(text):
+                text = text.encode('utf-8')
+                stream.append(b'data %d\n%s\n' % (len(text), text))
+
+            stream.append(('commit %s\ncommitter %s\n' % (self.ref, git('var GIT_COMMITTER_IDENT'))).encode('utf-8'))
+            data(message + '\n')
+            parent = git('rev-parse -q --verify ' + self.ref, errorValue='')
+            if parent:
+                stream.append(('from %s\n' % parent).encode('utf-8'))
+            for commit, text in self.pending.items():
+                if text is None:
+                    stream.append(('N %s %s\n' % ('0' * len(commit), commit)).encode('utf-8'))
+                    continue
+                stream.append(('N inline %s\n' % commit).encode('utf-8'))
+                data(text + '\n')
+            git('fast-import --quiet', input=b''.join(stream))
+            self.pending.clear()
+
+        if self._journal is not None:
+            # other running writers remove the journal at their flush
+            if self._lock(exclusive=True):
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(self.journalPath())
+            self._close()
+
+    def recover(self):
+        """Returns {commit: text} of the notes journaled by a run that did not write them.
+
+        Nothing is returned while a process that wrote the journal is running.
+        The journal is kept until the next flush().
+        """
+        if not os.path.exists(self.journalPath()):
+            return {}
+        if self._journal is None:
+            if not self._open(exclusive=True):
+                return {}
+        elif not self._lock(exclusive=True):
+            return {}
+
+        notes = {}
+        with open(self.journalPath()) as f:
+            for line in f:
+                commit, sep, text = line.rstrip('\n').partition(' ')
+                if commit:
+                    notes[commit] = text if sep else None
+        # let other processes write notes while this one writes the recovered ones
+        self._lock(exclusive=False)
+        return notes
+
+
+class FastImport(object):
+    """Streams commits to a branch through one git fast-import process.
+
+    The branch and the notes of the commits are updated only by checkpoint() and close().
+    The stream declares "feature done", so if git-tf dies, fast-import updates nothing.
+    """
+
+    def __init__(self, branch, head, notesRef):
+        self.branch = branch
+        self.notesRef = notesRef
+        self._from = head
+        self._mark = 0
+        self._notes = []
+        self._notesStarted = False
+        self._committer = git('var GIT_COMMITTER_IDENT').rsplit(' ', 2)[0]
+        self._process = PersistentProcess(git.genArgv('fast-import --quiet'), (git.name, 'git fast-import'))
+        self._process.write(b'feature done\n')
+
+    @staticmethod
+    def _data(text):
+        text = text.encode('utf-8') if isinstance(text, str) else text
+        return b'data %d\n%s\n' % (len(text), text)
+
+    @staticmethod
+    def _date(date):
+        """Formats a timezone-aware datetime as a raw git date."""
+        return '%d %s' % (date.timestamp(), date.strftime('%z'))
+
+    @staticmethod
+    def _mode(path):
+        """Returns the git mode of a worktree file, as update-index records it."""
+        mode = os.lstat(path).st_mode
+        if stat.S_ISLNK(mode):
+            return '120000'
+        executable = mode & stat.S_IXUSR and (config.get('core.filemode') or 'true').lower() != 'false'
+        return '100755' if executable else '100644'
+
+    def commit(self, message, author, date, files=(), deleted=(), tree=None, note=None):
+        """Adds a commit on top of the branch.
+
+        files are (path, blob hash) pairs of worktree files, whose modes are read from the worktree,
+        and deleted are files or folders. If tree is given, it replaces the whole tree first.
+        note is written to notesRef at the next checkpoint.
+        """
+        self._mark += 1
+        now = datetime.datetime.now(datetime.timezone.utc).astimezone()
+        stream = [('commit %s\nmark :%d\nauthor %s <%s> %s\ncommitter %s %s\n' % (
+            self.branch, self._mark, author[0], author[1], self._date(date), self._committer,
+            self._date(now))).encode('utf-8'), self._data(message if message.endswith('\n') else message + '\n')]
+        if self._from:
+            stream.append(('from %s\n' % self._from).encode('utf-8'))
+            self._from = None
+        if tree:
+            stream.append(('M 040000 %s ""\n' % tree).encode('utf-8'))
+        stream += [('D %s\n' % path).encode('utf-8') for path in deleted]
+        stream += [('M %s %s %s\n' % (self._mode(path), hash, path)).encode('utf-8') for path, hash in files]
+        stream.append(b'\n')
+        self._process.write(b''.join(stream))
+        if note is not None:
+            self._notes.append((self._mark, note))
+
+    def _writeNotes(self):
+        if not self._notes:
+            return
+        now = datetime.datetime.now(datetime.timezone.utc).astimezone()
+        stream = [('commit %s\ncommitter %s %s\n' % (self.notesRef, self._committer, self._date(now))).encode('utf-8'),
+                  self._data('Notes added by git-tf\n')]
+        if not self._notesStarted:
+            # later notes commits continue the branch fast-import already has
+            parent = git('rev-parse -q --verify ' + self.notesRef, errorValue='')
+            if parent:
+                stream.append(('from %s\n' % parent).encode('utf-8'))
+            self._notesStarted = True
+        for mark, text in self._notes:
+            stream.append(('N inline :%d\n' % mark).encode('utf-8'))
+            stream.append(self._data(text + '\n'))
+        self._process.write(b''.join(stream) + b'\n')
+        self._notes = []
+
+    def checkpoint(self):
+        """Writes the notes and waits until fast-import has updated the refs."""
+        self._writeNotes()
+        self._process.write(b'checkpoint\nprogress checkpoint\n\n')
+        self._process.expect('progress checkpoint')
+
+    def close(self):
+        self._writeNotes()
+        self._process.write(b'done\n')
+        exitCode = self._process.close()
+        if exitCode:
+            fail('git fast-import exited with code %s' % exitCode)
+
+    def abort(self):
+        """Stops fast-import. Nothing after the last checkpoint is written."""
+        self._process.kill()
+
+
+class NotesIndex(abc.ABC):
+    """Values of commits parsed from the notes of a notes ref.
+
+    It is built with one "notes list" and one "cat-file --batch" run, and is cached in .git/<cacheFile>
+    while the notes ref does not change. Changed notes are written by flush() as one notes commit.
+    Subclasses parse and format note texts and keep reverse maps in _set and _clear.
+    """
+    ref = None
+    cacheFile = None
+    noteName = None
+    flushMessage = 'Notes added by git-tf'
+
+    def __init__(self):
+        self._values = None
+        self._cachePath = None
+        self._notesHash = None
+        self._dirty = False
+        self.notes = NotesBatch(self.ref)
+
+    @abc.abstractmethod
+    def _parse(self, text):
+        """Returns the value of a note text, or None if the note has none."""
+
+    @abc.abstractmethod
+    def _format(self, value):
+        """Returns the note text of a value, or None if the note is to be removed."""
+
+    def _set(self, commit, value):
+        self._values[commit] = value
+
+    def _clear(self):
+        self._values = {}
+
+    def load(self):
+        self._clear()
+        self._dirty = False
+        self._cachePath = git.gitPath(self.cacheFile)
+        self._loadNotes()
+        self._recover()
+
+    def _loadNotes(self):
+        notesHash = self._notesHash = git('rev-parse -q --verify ' + self.ref, errorValue='') or None
+        if not notesHash:
+            return
+
+        try:
+            with open(self._cachePath) as f:
+                if f.readline().strip() == notesHash:
+                    for line in f:
+                        commit, text = line.split()
+                        self._set(commit, self._parse(text))
+                    return
+        except (IOError, ValueError):
+            self._clear()
+
+        notes = [line.split() for line in git('notes --ref=%s list' % self.ref).splitlines()]
+        values = {blob: self._parse(text or '') for blob, text in git.catFiles(set(blob for blob, _ in notes))}
+        for blob, commit in notes:
+            if values.get(blob) is not None:
+                self._set(commit, values[blob])
+        self._dirty = True
+        self.save()
+
+    def _recover(self):
+        journal = self.notes.recover()
+        if not journal:
+            return
+        print('Recovering %d %s note(s) of an interrupted run' % (len(journal), self.noteName))
+        for commit, text in journal.items():
+            value = self._parse(text or '')
+            if value is not None and git.resolve(commit):
+                self._put(commit, value)
+        self.flush()
+
+    def _ensureLoaded(self):
+        if self._values is None:
+            self.load()
+
+    def _put(self, commit, value):
+        """Sets the value of a commit hash. The note is written by flush()."""
+        self._ensureLoaded()
+        self._set(commit, value)
+        self.notes.add(commit, self._format(value))
+        self._dirty = True
+
+    def flush(self):
+        """Writes the changed notes and updates the cache."""
+        self.notes.flush(self.flushMessage)
+        self.save()
+
+    def invalidate(self):
+        self._values = None
+
+    def refresh(self):
+        """Drops the loaded index if another process has changed the notes. Used by long-running processes."""
+        if self._values is not None and not self.notes.pending and git.resolve(self.ref) != self._notesHash:
+            self.invalidate()
+
+    def save(self):
+        if not self._dirty or self.notes.pending:
+            return
+        notesHash = self._notesHash = git('rev-parse -q --verify ' + self.ref, errorValue='') or None
+        if notesHash:
+            with open(self._cachePath, 'w') as f:
+                f.write(notesHash + '\n')
+                f.writelines('%s %s\n' % (commit, self._format(value)) for commit, value in self._values.items())
+        self._dirty = False
+
+
+class ChangesetIndex(NotesIndex):
+    """Bidirectional map between commits and changeset numbers, built from the tf notes."""
+    ref = 'refs/notes/tf'
+    cacheFile = 'tf-index'
+    noteName = 'tf'
+
+    def _parse(self, text):
+        found = re.findall(r'^\d+', text, re.M)
+        return found[-1] if found else None
+
+    def _format(self, changeset):
+        return changeset
+
+    def _set(self, commit, changeset):
+        self._values[commit] = changeset
+        self._commits[changeset] = commit
+
+    def _clear(self):
+        self._values = {}
+        self._commits = {}
+
+    def changeset(self, commit):
+        """Returns the changeset number of a commit (a hash or any revision) or None."""
+        self._ensureLoaded()
+        if commit not in self._values and not re.fullmatch('[0-9a-f]{40}|[0-9a-f]{64}', commit):
+            commit = git.resolve(commit)
+        return self._values.get(commit)
+
+    def commit(self, changeset):
+        """Returns the hash of the commit synchronized with a changeset or None."""
+        self._ensureLoaded()
+        return self._commits.get(str(changeset))
+
+    def commitRange(self, first, last=None):
+        """Returns the (oldest, newest) commits of the changesets from first to last or None if there are none."""
+        self._ensureLoaded()
+        numbers = sorted(n for n in map(int, self._commits) if first <= n and (last is None or n <= last))
+        return numbers and (self._commits[str(numbers[0])], self._commits[str(numbers[-1])]) or None
+
+    def add(self, commit, changeset):
+        """Marks a commit with a changeset number. The note is written by flush()."""
+        self._ensureLoaded()
+        self._put(git.resolve(commit), str(changeset))
+
+changesetIndex = ChangesetIndex()
 
 #######      TFS       #######
 
 
 class _tf(Runner):
-    prefix = git('config tf.cmd', errorValue='tf')
-    paramPrefix = git('config tf.paramPrefix', errorValue='') or '/' if os.name == 'nt' else '-'
+    name = 'tf'
+    notFoundMsg = 'tf not found. Specify its path in tf.cmd config value: git config --global tf.cmd <path>'
+
+    @property
+    def prefix(self):
+        return config.get('tf.cmd', 'tf')
+
+    @property
+    def paramPrefix(self):
+        return (config.get('tf.paramPrefix') or '/') if os.name == 'nt' else '-'
 
     def argsToStr(self, args):
         if type(args) == str and self.paramPrefix != '-':
             args = args.replace('-', self.paramPrefix)
         return Runner.argsToStr(self, args)
 
+    def traceLabel(self, args):
+        words = [w for w in self.argsToStr(args).split() if not w.startswith(('-', self.paramPrefix))]
+        if words and words[0].strip('"').startswith('@'):
+            return 'tf @commandfile'
+        return ' '.join([self.name] + words[:1])
+
     class Changeset(object):
+        """A history entry. The date and the display line are computed on first access."""
+        __slots__ = ('id', 'comment', 'dateIso', '_committer', '_date', '_line')
+
         def __init__(self, node):
             self.id = node.get('id')
             if not self.id:
                 fail('Could not determine changeset id: %s' % node)
-            self.comment = node.find('comment')
-            self.comment = self.comment is not None and self.comment.text or ''
+            comment = node.find('comment')
+            self.comment = comment is not None and comment.text or ''
             self.dateIso = node.get('date')
-            self.date = parseXmlDatetime(self.dateIso)
-            self.committer = node.get('committer').split('\\', 1)[-1].strip()
-            self.line = ' '.join((self.id, self.committer, self.date.ctime(), self.comment))\
-                .strip().replace('\n', ' ')[:128]
-
-    def history(self, version=None, stopAfter=None):
+            self._committer = node.get('committer')
+            self._date = self._line = None
+
+        def record(self):
+            """Returns the changeset as a list of strings, see fromRecord."""
+            return [self.id, self._committer, self.dateIso, self.comment]
+
+        @classmethod
+        def fromRecord(cls, record):
+            cs = cls.__new__(cls)
+            cs.id, cs._committer, cs.dateIso, cs.comment = record
+            cs._date = cs._line = None
+            return cs
+
+        @property
+        def committer(self):
+            return self._committer.split('\\', 1)[-1].strip()
+
+        @property
+        def date(self):
+            if self._date is None:
+                self._date = parseXmlDatetime(self.dateIso)
+            return self._date
+
+        @property
+        def line(self):
+            if self._line is None:
+                self._line = ' '.join((self.id, self.committer, self.date.ctime(), self.comment))\
+                    .strip().replace('\n', ' ')[:128]
+            return self._line
+
+    class PendingChange(object):
+        """A pending change of the workspace, with paths relative to the current directory."""
+        __slots__ = ('path', 'sourcePath', 'changeType')
+
+        def __init__(self, node, root):
+            local, server = node.get('local-item'), node.get('server-item')
+            self.changeType = node.get('change-type', '')
+            self.path = self._relative(local, root)
+            # renamed items have the server path of the source only
+            source = node.get('source-item')
+            self.sourcePath = None
+            if source and server and local and self.path is not None:
+                common = len(os.path.commonprefix([server[::-1], local.replace(os.sep, '/')[::-1]]))
+                localRoot, serverRoot = local[:len(local) - common], server[:len(server) - common]
+                if source.startswith(serverRoot):
+                    self.sourcePath = self._relative(localRoot + source[len(serverRoot):], root)
+
+        @staticmethod
+        def _relative(path, root):
+            """Returns a path relative to root or None if it is outside."""
+            if not path:
+                return None
+            path = os.path.relpath(path, root)
+            return None if path.split(os.sep)[0] == '..' else path.replace(os.sep, '/')
+
+        @property
+        def paths(self):
+            return [p for p in (self.sourcePath, self.path) if p]
+
+    historyPageSize = 500
+
+    def history(self, version=None, stopAfter=None, idsOnly=False):
+        """Yields changesets, newest first, while tf is still printing the history.
+
+        With idsOnly, yields only changeset numbers as soon as their tags are opened.
+        """
         filter = ['']
         if version:
             filter[0] += '-version:C{}~C{}'
@@ -167,15 +1083,69 @@ class _tf(Runner):
             filter.append(stopAfter)
 
         args = ('history -recursive -format:xml {} .', filter)
-        history = etree.fromstring(self(args))
-        return [self.Changeset(cs) for cs in history if cs.tag == 'changeset']
+        # tf exits with 1 if a version range has no changesets
+        allowedExitCodes = [0, 1] if version else [0]
+        # imported on first use: most commands never parse tf output, and startup time matters
+        import xml.etree.ElementTree as etree
+        parser = etree.XMLPullParser(['start', 'end'])
+        root = None
+        started = False
+        for line in self.stream(args, allowedExitCodes=allowedExitCodes):
+            # skip messages such as "No history entries were found" before the XML
+            started = started or line.lstrip().startswith('<')
+            if not started:
+                continue
+            parser.feed(line + '\n')
+            for event, node in parser.read_events():
+                if root is None:
+                    root = node
+                elif node.tag != 'changeset':
+                    continue
+                elif idsOnly and event == 'start':
+                    yield node.get('id')
+                elif not idsOnly and event == 'end':
+                    yield self.Changeset(node)
+                    # drop parsed changesets, so memory does not grow with the history
+                    root.clear()
+        if started:
+            parser.close()
+
+    def historyAscending(self, first, last):
+        """Yields changesets first..last, oldest first.
+
+        Changeset numbers are shared by the whole collection, so the history of a folder is usually sparse.
+        The whole range is requested first, at most historyPageSize changesets at a time. If tf stops after
+        historyPageSize changesets, the window is dense and is narrowed to the numbers that fit into a page.
+        It widens again while pages are sparse.
+        """
+        first, last = int(first), int(last)
+        window = last - first + 1
+        while first <= last:
+            upper = min(first + window - 1, last)
+            page = list(self.history(version=(first, upper), stopAfter=self.historyPageSize + 1))
+            if len(page) > self.historyPageSize and upper > first:
+                # tf printed the newest changesets only. They span fewer numbers than the window
+                span = upper - int(page[-1].id) + 1
+                window = max(min(span, window) * 3 // 4, 1)
+                continue
+            page.reverse()
+            yield from page
+            if len(page) < self.historyPageSize // 2:
+                window = window * 2 if page else last - upper
+            first = upper + 1
+
+    def latestChangeset(self):
+        return first(self.history(stopAfter=1))
+
+    def latestChangesetId(self):
+        return first(self.history(stopAfter=1, idsOnly=True))
 
     def getDomain(self):
-        domain = git('config tf.domain', errorValue='')
+        domain = config.get('tf.domain')
         if domain:
             return domain
 
-        email = git('config user.email')
+        email = config.get('user.email')
         if not email:
             print('Email not set. Configure it:')
             fail('$ git config user.email userName@yourTfsServer.com')
@@ -187,26 +1157,104 @@ class _tf(Runner):
     def get(self, version, **kwargs):
         return self(('get -version:{} -recursive .', version), **kwargs)
 
+    def getPaths(self, version, paths, **kwargs):
+        """Gets only the given files and folders of a version."""
+        return self.runForPaths(('get -version:{} -recursive', version), paths, **kwargs)
+
+    def runForPaths(self, command, paths, chunkSize=100, **kwargs):
+        """Runs a command for the paths in a single tf process, a hundred paths per command."""
+        paths = sorted(paths)
+        command = self.argsToStr(command)
+        return self.runAll([('{} {}', command, ' '.join('"%s"' % p for p in paths[i:i + chunkSize]))
+                            for i in range(0, len(paths), chunkSize)], **kwargs)
+
+    # tf get actions: whether the file is written (True) or removed (False)
+    getActions = {'Getting': True, 'Replacing': True, 'Undeleting': True, 'Deleting': False}
+
+    def parseGet(self, output):
+        """Parses tf get output into (written, deleted) paths relative to the current directory.
+
+        Returns None if the output contains anything unexpected.
+        """
+        written, deleted = [], []
+        root = os.path.abspath('.')
+        folder = None
+        for line in output.splitlines():
+            line = line.rstrip()
+            if not line:
+                continue
+            if line.endswith(':') and os.path.isabs(line[:-1]):
+                folder = os.path.relpath(line[:-1], root)
+                if folder.split(os.sep)[0] == '..':
+                    return None
+                continue
+            action, _, name = line.partition(' ')
+            if folder is None or action not in self.getActions or not name:
+                return None
+            path = os.path.normpath(os.path.join(folder, name)).replace(os.sep, '/')
+            (written if self.getActions[action] else deleted).append(path)
+        return written, deleted
+
+    def runAll(self, commands, **kwargs):
+        """Runs several commands in a single tf process using a command file.
+
+        tf stops at the first failing command. Arguments are the same as for __call__.
+        """
+        commands = [self.argsToStr(c) for c in commands]
+        if not commands:
+            return ''
+        if _curCommand and _curCommand.args.verbose > 1:
+            printIndented(['$ tf ' + c for c in commands])
+        import tempfile
+        with tempfile.NamedTemporaryFile('w', suffix='.tfc', delete=False) as commandFile:
+            commandFile.write('\n'.join(commands) + '\n')
+        try:
+            return self(('"@{}"', commandFile.name), **kwargs)
+        finally:
+            os.remove(commandFile.name)
+
     def hasPendingChanges(self):
         return self('status') != 'There are no matching pending changes.'
 
+    def pendingChanges(self):
+        """Returns the pending changes under the current directory."""
+        import xml.etree.ElementTree as etree
+        status = etree.fromstring(self('status -format:xml -recursive .').encode('utf-8'))
+        root = os.path.abspath('.')
+        changes = [self.PendingChange(node, root) for node in status.iterfind('pending-changes/pending-change')]
+        return [c for c in changes if c.path is not None]
+
 tf = _tf()
 
 
 class ReadOnlyWorktree(object):
+    """Makes worktree files read-only, as tf expects, and writable again on exit.
+
+    Only files git knows about (tracked and untracked, never .git) are considered, and only
+    those whose permission actually has to change are chmodded. On exit these files and the
+    files that differ from the HEAD at entry are made writable.
+    """
+
     def __init__(self, output=False):
         self.output = output
 
     def __enter__(self):
         if self.output:
             print('Making files read-only')
-        chmod('.', False)
-        chmod('.git', True)
+        with tracer.span('ReadOnlyWorktree.enter'):
+            self._head = git('rev-parse -q --verify HEAD', errorValue='')
+            self._readOnly = setWritable(worktreeFiles('--cached --others'), False)
 
     def __exit__(self, _, __, ___):
         if self.output:
             print('Making files writable')
-        chmod('.', True)
+        with tracer.span('ReadOnlyWorktree.exit'):
+            paths = set(self._readOnly)
+            if self._head:
+                paths.update(splitNul(git('diff --name-only --relative --no-renames -z ' + self._head)))
+            else:
+                paths.update(worktreeFiles('--cached'))
+            setWritable(paths, True)
 
 ######       App           #######
 
@@ -224,6 +1272,11 @@ class Command:
     def initArgParser(self, parser):
         parser.set_defaults(cmd=self, dryRun=False, verbose=0, noChecks=False)
         self._initArgParser(parser)
+        parser.add_argument('--trace', metavar='FILE', default=os.environ.get('GIT_TF_TRACE') or None,
+            help='write a Chrome trace of git and tf commands to FILE and print the slowest ones. '
+                 '{pid} in FILE is replaced with the process ID. Defaults to $GIT_TF_TRACE')
+        parser.add_argument('--profile', action='store_true',
+            help='profile git-tf itself and print the functions that took most time')
 
     def _initArgParser(self, parser):
         pass
@@ -235,13 +1288,14 @@ class Command:
         self._free.append(lambda: os.chdir(origDir))
 
     def checkStatus(self, checkTfs=None, checkGit=True):
-        if checkGit and git('status -s') != '':
-            fail('Worktree is dirty. Stash your changes before proceeding.')
+        with tracer.span('checkStatus'):
+            if checkGit and git('status -s') != '':
+                fail('Worktree is dirty. Stash your changes before proceeding.')
 
-        if checkTfs is True and not self.args.noChecks:
-            print('Checking TFS status. There must be no pending changes...')
-            if tf.hasPendingChanges():
-                fail('TFS status is dirty!')
+            if checkTfs is True and not self.args.noChecks:
+                print('Checking TFS status. There must be no pending changes...')
+                if tf.hasPendingChanges():
+                    fail('TFS status is dirty!')
 
     def switchBranch(self, branch='tfs', allowNoBranch=False):
         def getCurBranch():
@@ -265,6 +1319,8 @@ class Command:
         pass
 
     def __exit__(self, *rest):
+        changesetIndex.flush()
+        config.flush()
         for a in self._free:
             a()
 
@@ -272,6 +1328,20 @@ class Command:
         pass
 
     def runWithArgs(self, args):
+        if not args.profile:
+            self._runWithArgs(args)
+            return
+
+        import cProfile
+        import pstats
+        profile = cProfile.Profile()
+        try:
+            profile.runcall(self._runWithArgs, args)
+        finally:
+            print()
+            pstats.Stats(profile).sort_stats('cumulative').print_stats(25)
+
+    def _runWithArgs(self, args):
         if args.verbose:
             print('Parsed arguments:')
             printIndented(str(args))
@@ -285,13 +1355,20 @@ class Command:
         if _curCommand:
             raise AssertionError('Only one Command can run at a time')
         _curCommand = self
+        if args.trace:
+            tracer.start(args.trace, 'git tf ' + type(self).__name__)
         try:
-            with self:
-                self._run()
+            with tracer.span(type(self).__name__):
+                with self:
+                    self._run()
         except GitTfException:
-            quit(1)
+            sys.exit(1)
         finally:
             _curCommand = None
+            if tracer.enabled:
+                # batch processes are recorded when they exit
+                git.close()
+                tracer.finish()
 
     def run(self):
         parser = argparse.ArgumentParser(**self.argParserCtorArgs())
@@ -321,24 +1398,88 @@ class ArgParser(argparse.ArgumentParser):
         self.add_argument('-f', '--force', action='store_true', help=help)
 
 
+def first(items):
+    """Returns the first item of a generator, or None, and stops the generator."""
+    try:
+        return next(items, None)
+    finally:
+        items.close()
+
+
 def parseXmlDatetime(text):
     return datetime.datetime.strptime(text, '%Y-%m-%dT%H:%M:%S.%f%z')
 
 
+def splitNul(text):
+    return [item for item in text.split('\0') if item]
+
+
+def worktreeFiles(options=''):
+    """Lists files known to git relative to the current directory."""
+    return splitNul(git('ls-files -z ' + options))
+
+
+def walkFiles(path):
+    """Yields DirEntry objects of all files under path, skipping .git directories."""
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if not entry.is_dir(follow_symlinks=False):
+                yield entry
+            elif entry.name != '.git':
+                yield from walkFiles(entry.path)
+
+
+def setWritable(paths, writable, threads=8):
+    """Sets or clears the write permission of files (paths or DirEntry objects) on a thread pool.
+
+    Symbolic links and missing files are skipped. Returns the paths whose permission changed.
+    """
+    def update(chunk):
+        changed = []
+        for path in chunk:
+            try:
+                if isinstance(path, os.DirEntry):
+                    mode = path.stat(follow_symlinks=False).st_mode
+                    path = path.path
+                else:
+                    mode = os.lstat(path).st_mode
+            except FileNotFoundError:
+                continue
+            if stat.S_ISLNK(mode):
+                continue
+            newMode = mode | stat.S_IWRITE if writable else mode & ~stat.S_IWRITE
+            if newMode != mode:
+                os.chmod(path, stat.S_IMODE(newMode))
+                changed.append(path)
+        return changed
+
+    paths = list(paths)
+    chunkSize = max(1024, len(paths) // threads + 1)
+    if len(paths) <= chunkSize:
+        return update(paths)
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(threads) as pool:
+        chunks = pool.map(update, [paths[i:i + chunkSize] for i in range(0, len(paths), chunkSize)])
+        return list(chain.from_iterable(chunks))
+
+
 def chmod(path, writable, rec=True):
-    def update(path):
-        mode = os.stat(path).st_mode
-        if writable:
-            mode |= stat.S_IWRITE
-        else:
-            mode &= ~stat.S_IWRITE
-        os.chmod(path, mode)
-    if not rec:
-        update(path)
+    setWritable(walkFiles(path) if rec else [path], writable)
+
+
+def removePath(path):
+    """Removes a file or a folder, even if it is read-only, and the folders it leaves empty."""
+    if os.path.isdir(path) and not os.path.islink(path):
+        chmod(path, True)
+        shutil.rmtree(path)
     else:
-        for root, dirnames, filenames in os.walk(path):
-            for filename in filenames:
-                update(os.path.join(root, filename))
+        chmod(path, True, False)
+        os.remove(path)
+    try:
+        os.removedirs(os.path.dirname(path))
+    except OSError:
+        # the folder is not empty or it is the root
+        pass
 
 
 def mkdir(path, parents=False):
@@ -351,7 +1492,7 @@ def mkdir(path, parents=False):
     parents = [path]
     while True:
         parent = os.path.split(parents[0])[0]
-        if os.path.exists(parent):
+        if not parent or os.path.exists(parent):
             break
         parents.insert(0, parent)
 
@@ -369,11 +1510,173 @@ def printIndented(text, indent=1):
         print('  ' * indent + line)
 
 
-_terminalHeight, terminalWidth = [int(x) for x in os.popen('stty size', 'r').read().split()] or [24, 80]
+def terminalSize():
+    """Returns (columns, lines) of the terminal, or 80x24 if the output is not a terminal."""
+    return shutil.get_terminal_size()
+
+
+class Progress(object):
+    """Measures throughput of a loop and estimates the time left.
+
+    If the number of items is unknown, it is estimated from the changeset numbers
+    processed so far within idRange.
+    """
+
+    def __init__(self, total=None, idRange=None):
+        self.total = total
+        self.idRange = idRange and [int(i) for i in idRange]
+        self.done = 0
+        self.lastId = None
+        self.started = time.time()
+
+    def step(self, id=None):
+        self.done += 1
+        self.lastId = id
+
+    @property
+    def elapsed(self):
+        return time.time() - self.started
+
+    @property
+    def perMinute(self):
+        return self.done * 60 / max(self.elapsed, 0.001)
+
+    def estimatedTotal(self):
+        if self.total is not None:
+            return self.total
+        if self.idRange and self.lastId is not None:
+            first, last = self.idRange
+            covered = int(self.lastId) - first + 1
+            if covered > 0:
+                return self.done * max(last - first + 1, covered) / covered
+        return None
+
+    @property
+    def eta(self):
+        total = self.estimatedTotal()
+        if total is None or not self.done:
+            return None
+        return max(total - self.done, 0) * self.elapsed / self.done
+
+    def __str__(self):
+        text = '%d in %s, %.1f/min' % (self.done, formatDuration(self.elapsed), self.perMinute)
+        eta = self.eta
+        if eta is not None:
+            text += ', ETA ' + formatDuration(eta)
+        return text
+
+
+class Stages(object):
+    """Measures the time of named stages of work, which may run on different threads."""
+
+    def __init__(self):
+        self.started = time.time()
+        self.timings = []
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        started = time.time()
+        try:
+            with tracer.span(name):
+                yield
+        finally:
+            with self._lock:
+                self.timings.append((name, time.time() - started))
+
+    def run(self, name, func, *args):
+        with self.stage(name):
+            return func(*args)
+
+    def __str__(self):
+        stages = ', '.join('%s %.1fs' % timing for timing in self.timings)
+        return '%s (%.1fs in total)' % (stages, time.time() - self.started)
+
+
+class Tracer(object):
+    """Records commands and spans of work as a Chrome trace (chrome://tracing, Perfetto).
+
+    Nothing is recorded until start(). finish() writes the trace and prints the commands
+    that took most time.
+    """
+
+    def __init__(self):
+        self.path = None
+        self.events = []
+        self.commands = {}
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.path is not None
+
+    def start(self, path, name):
+        """Starts recording. {pid} in the path is replaced with the process ID."""
+        self.path = path.replace('{pid}', str(os.getpid()))
+        self.events = [{'name': 'process_name', 'ph': 'M', 'pid': os.getpid(), 'args': {'name': name}}]
+        self.commands = {}
+
+    def _add(self, name, category, started, duration, args):
+        event = {'name': name, 'cat': category, 'ph': 'X', 'ts': int(started * 1e6), 'dur': int(duration * 1e6),
+                 'pid': os.getpid(), 'tid': threading.get_ident(), 'args': args}
+        with self._lock:
+            self.events.append(event)
+
+    @contextlib.contextmanager
+    def span(self, name, **args):
+        """Records the time of a block of work."""
+        if not self.enabled:
+            yield
+            return
+        started = time.time()
+        try:
+            yield
+        finally:
+            self._add(name, 'span', started, time.time() - started, args)
+
+    def command(self, runner, label, cmd, started, exitCode, outputBytes, persistent=False):
+        """Records a finished command. Commands are summarized by label.
+
+        A persistent process mostly waits for requests, so its time is not added to the time in commands.
+        """
+        if not self.enabled:
+            return
+        duration = time.time() - started
+        self._add(label, runner, started, duration, {'command': cmd, 'exitCode': exitCode, 'outputBytes': outputBytes,
+                                                     'persistent': persistent})
+        with self._lock:
+            calls, total, longest = self.commands.get(label, (0, 0, 0))
+            self.commands[label] = (calls + 1, total + duration, max(longest, duration))
+
+    def finish(self, top=10):
+        if not self.enabled:
+            return
+        import json
+        with open(self.path, 'w') as f:
+            json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms'}, f)
+        print()
+        print('Trace written to', self.path)
+        runners = {}
+        for event in self.events:
+            if event.get('cat') in ('git', 'tf', 'run') and not event['args']['persistent']:
+                runners[event['cat']] = runners.get(event['cat'], 0) + event['dur'] / 1e6
+        print('Time in commands:', ', '.join('%s %.2fs' % item for item in sorted(runners.items())) or 'none')
+        print('%-32s %6s %9s %9s' % ('Command', 'Calls', 'Total', 'Max'))
+        for label, (calls, total, longest) in sorted(self.commands.items(), key=lambda i: -i[1][1])[:top]:
+            print('%-32s %6d %8.2fs %8.2fs' % (label, calls, total, longest))
+        self.path = None
+
+tracer = Tracer()
+
+
+def formatDuration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return '%d:%02d:%02d' % (hours, minutes, seconds)
 
 
 def printLine():
-    print('_' * terminalWidth)
+    print('_' * terminalSize().columns)
 
 
 def printLess(lines):
@@ -384,9 +1687,10 @@ def printLess(lines):
 
     (forPrint, forLess) = tee(lines, 2)
     doLess = False
+    height = terminalSize().lines
     for i, line in enumerate(forPrint):
         print(line)
-        if i >= _terminalHeight - 2:
+        if i >= height - 2:
             doLess = True
             break
 
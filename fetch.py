@@ -1,7 +1,8 @@
 #!/usr/bin/env python3
 from core import *
 import re
-import tempfile
+import shutil
+import bisect
 
 _allFilesUpToDate = 'All files up to date.'
 
@@ -18,9 +19,20 @@ class fetch(Command):
 
     def __enter__(self):
         self.moveToRootDir()
+        self._recover()
         self.checkStatus()
         self.switchBranch()
 
+    def _recover(self):
+        """Rolls back a fetch that was killed. Such a fetch leaves its temporary index behind."""
+        index = git.gitPath('tf-fetch-index')
+        if self.args.dryRun or not os.path.exists(index):
+            return
+        print('Rolling back an interrupted fetch')
+        with ReadOnlyWorktree(self.args.verbose):
+            self.rollback()
+        os.remove(index)
+
     def _run(self):
         tf.getDomain()
 
@@ -33,7 +45,7 @@ class fetch(Command):
             lastChangeset = None
             git.failNoLastChangeset()
 
-        latestChangeset = tf.history(stopAfter=1)[0].id
+        latestChangeset = tf.latestChangesetId()
         if self.args.verbose:
             print('Latest changeset on TFS:', latestChangeset)
         if lastChangeset == latestChangeset:
@@ -41,63 +53,253 @@ class fetch(Command):
             return False
 
         print('Requesting tf history %s..%s' % (lastChangeset, latestChangeset))
-        history = tf.history(version=(lastChangeset, latestChangeset))
-        history.reverse()
-        history.pop(0)
-        history = history[:self.args.number]
+        history = tf.historyAscending(int(lastChangeset) + 1, latestChangeset)
+        return self.doFetch(islice(history, self.args.number), idRange=(int(lastChangeset) + 1, latestChangeset))
+
+    reportInterval = 10
+    checkpointInterval = 1000
 
-        self.doFetch(history)
+    def doFetch(self, history, idRange=None):
+        """Fetches changesets from an iterable, oldest first. Returns False if there was nothing to fetch.
 
-    def doFetch(self, history):
-        print('%d changeset(s) to fetch' % len(history))
+        Each changeset is staged into a temporary index, so only the files tf get reports are
+        hashed, and committed with commit-tree.
+
+        idRange is the (first, last) changeset numbers used to estimate the time left when the number
+        of changesets is unknown. Every checkpointInterval commits the notes are written.
+        """
+        self._progress = self._count(history, idRange)
         domain = tf.getDomain()
         dryRun = self.args.dryRun
         verbose = self.args.verbose
 
+        self._head = git('rev-parse HEAD')
+        index = git.gitPath('tf-fetch-index')
+        if os.path.exists(git.gitPath('index')):
+            shutil.copyfile(git.gitPath('index'), index)
+        fetched = 0
+        # changes got by tf but not committed yet, None if they are unknown
+        self._uncommitted = {}
         with ReadOnlyWorktree(verbose):
             try:
-                for i, cs in enumerate(history):
-                    if verbose:
-                        printLine()
-                    print('Fetching [%d/%d] "%s"...' % (i + 1, len(history), cs.line))
-                    tfgetResponse = tf.get(cs.id, dryRun=dryRun, output=verbose).strip()
-                    if tfgetResponse == _allFilesUpToDate and not self.args.force:
-                        print()
-                        print('tf did not fetch anything. Usually it happens when the local folder contents is '
-                              'different from what TFS expects.')
-                        print('Try to repair tf state by retrieving an old changeset and then returning to this one')
-                        print('Or use --force option if you are absolutely sure that the changeset didn\'t actually '
-                              'change any files.')
-                        fail()
-
-                    if verbose:
-                        print('Committing to Git...')
-                    comment = cs.comment.strip() if cs.comment else None
-                    if not comment:
-                        if verbose:
-                            print('The comment is empty. Using changeset number as a comment')
-                        comment = str(cs.id)
-                    git('add -A .', dryRun=dryRun)
-                    with tempfile.NamedTemporaryFile('w') as tempFile:
-                        tempFile.file.write(comment)
-                        tempFile.file.close()
-                        commitArgs = r'commit --allow-empty -F %s --author="%s <%s@%s>" --date="%s"' % \
-                                     (tempFile.name, cs.committer, cs.committer, domain, cs.dateIso)
-                        git(commitArgs, output=verbose, dryRun=dryRun)
-                    git('notes add -m %s' % cs.id, dryRun=dryRun)
-                    if not verbose:
-                        print('Commit:', git('log -1 --format=%h'))
+                for cs in history:
+                    with tracer.span('changeset', id=cs.id):
+                        fetched += 1
+                        self._announce(cs, fetched, self._progress.total)
+                        self._uncommitted[cs.id] = None
+                        tfgetResponse = tf.get(cs.id, dryRun=dryRun, output=verbose)
+                        if dryRun:
+                            continue
+                        upToDate = tfgetResponse.strip() == _allFilesUpToDate
+                        if upToDate and not self.args.force:
+                            print()
+                            print('tf did not fetch anything. Usually it happens when the local folder contents is '
+                                  'different from what TFS expects.')
+                            print('Try to repair tf state by retrieving an old changeset and then returning to '
+                                  'this one')
+                            print('Or use --force option if you are absolutely sure that the changeset didn\'t '
+                                  'actually change any files.')
+                            fail()
+
+                        changes = ([], []) if upToDate else tf.parseGet(tfgetResponse)
+                        self._uncommitted[cs.id] = changes
+                        if changes is None and verbose:
+                            print('Could not parse tf get output. Staging the entire worktree')
+                        self._commit(cs, self._snapshot(index, changes), domain)
+                if self._progress.done:
+                    os.replace(index, git.gitPath('index'))
             except:
                 if not dryRun:
-                    lastSyncedChangeset = git.getChangesetNumber()
-                    if lastSyncedChangeset:
-                        print('Rolling back to the last synchronized changeset: %s' % lastSyncedChangeset)
-                        tf.get(lastSyncedChangeset, output=True)
-                    git('reset --hard')
-                    git('clean -fd')
+                    self.rollback(self._uncommitted.values())
+                raise
+            finally:
+                changesetIndex.flush()
+                if os.path.exists(index):
+                    os.remove(index)
+        self._summary(self._progress)
+        return fetched > 0
+
+    def doImport(self, history, idRange=None):
+        """Imports changesets from an iterable, oldest first. Returns False if there was nothing to import.
+
+        Unlike doFetch, it is meant for long histories of a new repository: files written by tf get
+        are hashed by a persistent git process, and commits with their tf notes are streamed to a single
+        git fast-import. tfs branch and the notes move every checkpointInterval changesets and at the end.
+        """
+        progress = self._count(history, idRange)
+        domain = tf.getDomain()
+        verbose = self.args.verbose
+
+        index = git.gitPath('tf-fetch-index')
+        stream = FastImport('refs/heads/tfs', git('rev-parse HEAD'), changesetIndex.ref)
+        # changes got by tf but not streamed yet, None if they are unknown
+        uncommitted = []
+        with ReadOnlyWorktree(verbose):
+            try:
+                for cs in history:
+                    with tracer.span('changeset', id=cs.id):
+                        self._announce(cs, progress.done + 1, progress.total)
+                        uncommitted = [None]
+                        tfgetResponse = tf.get(cs.id, output=verbose)
+                        if tfgetResponse.strip() == _allFilesUpToDate:
+                            changes = ([], [])
+                        else:
+                            changes = tf.parseGet(tfgetResponse)
+                        uncommitted = [changes]
+
+                        files, deleted, tree = [], [], None
+                        if changes is None:
+                            if verbose:
+                                print('Could not parse tf get output. Staging the entire worktree')
+                            if os.path.exists(index):
+                                os.remove(index)
+                            tree = self._snapshot(index, None)
+                        else:
+                            written, deleted = changes
+                            paths = self._files(written)
+                            files = zip(paths, git.hashObjects(paths))
+
+                        stream.commit(self._comment(cs), self._author(cs, domain), cs.date, files, deleted, tree,
+                                      note=cs.id)
+                        uncommitted = []
+                        if self._step(progress, cs):
+                            stream.checkpoint()
+                            changesetIndex.invalidate()
+                stream.close()
+            except:
+                try:
+                    # keep the changesets streamed before the failure, so a resumed clone continues after them
+                    stream.close()
+                except Exception:
+                    stream.abort()
+                changesetIndex.invalidate()
+                self.rollback(uncommitted)
                 raise
-        return True
+            else:
+                changesetIndex.invalidate()
+                # fast-import does not touch the index
+                git('reset -q')
+            finally:
+                if os.path.exists(index):
+                    os.remove(index)
+        self._summary(progress)
+        return progress.done > 0
+
+    def _count(self, history, idRange):
+        """Prints the number of changesets to fetch, if it is known, and returns their Progress."""
+        try:
+            total = len(history)
+            print('%d changeset(s) to fetch' % total)
+        except TypeError:
+            total = None
+        return Progress(total, idRange)
+
+    def _announce(self, cs, number, total):
+        if self.args.verbose:
+            printLine()
+        count = '%d/%d' % (number, total) if total is not None else str(number)
+        print('Fetching [%s] "%s"...' % (count, cs.line))
+
+    def _step(self, progress, cs):
+        """Counts a fetched changeset. Returns True every checkpointInterval changesets."""
+        progress.step(cs.id)
+        if progress.done % self.reportInterval == 0:
+            print('Fetched', progress)
+        return progress.done % self.checkpointInterval == 0
+
+    def _summary(self, progress):
+        # _step has printed it already if the number is a multiple of reportInterval
+        if progress.done % self.reportInterval:
+            print('Fetched', progress)
+
+    def _comment(self, cs):
+        comment = cs.comment.strip() if cs.comment else None
+        if not comment:
+            if self.args.verbose:
+                print('The comment is empty. Using changeset number as a comment')
+            comment = str(cs.id)
+        return comment
+
+    @staticmethod
+    def _author(cs, domain):
+        return cs.committer, '%s@%s' % (cs.committer, domain)
+
+    @staticmethod
+    def _files(paths):
+        """Expands folders reported by tf get to the files in them."""
+        files = []
+        for path in paths:
+            if os.path.isdir(path):
+                files += [entry.path.replace(os.sep, '/') for entry in walkFiles(path)]
+            else:
+                files.append(path)
+        return files
+
+    def rollback(self, changes=None):
+        """Returns the worktree and TFS workspace to the last synchronized changeset.
+
+        changes are (written, deleted) pairs of tf gets that were not committed. If all of them are known,
+        only these paths are restored from git and got from TFS. Otherwise the last synchronized
+        changeset is got entirely and other changes of the worktree are discarded.
+        """
+        lastSyncedChangeset = git.getChangesetNumber()
+        changes = None if changes is None else list(changes)
+        if lastSyncedChangeset and changes is not None and None not in changes:
+            paths = set(path for written, deleted in changes for path in chain(written, deleted))
+            print('Rolling back %d file(s) to the last synchronized changeset: %s' % (len(paths), lastSyncedChangeset))
+            try:
+                # tf does not write over writable files
+                setWritable(git.restore(paths), False)
+                if paths:
+                    tf.getPaths(lastSyncedChangeset, paths, output=True)
+                return
+            except GitTfException:
+                print('Could not roll back only these files')
+        if lastSyncedChangeset:
+            print('Rolling back to the last synchronized changeset: %s' % lastSyncedChangeset)
+            tf.get(lastSyncedChangeset, output=True)
+        git('reset --hard')
+        git('clean -fd')
+
+    def _snapshot(self, index, changes):
+        """Stages files changed by tf get into a temporary index and returns its tree.
+
+        changes is a (written, deleted) pair from tf.parseGet. If it is None, the entire worktree is staged.
+        """
+        env = {'GIT_INDEX_FILE': index}
+        if changes is None:
+            git('add -A .', env=env)
+            return git.writeTree(env=env)
+
+        written, deleted = changes
+        paths = self._files(written)
+        if deleted:
+            # tf may report a deleted folder, but the index has only files
+            indexed = splitNul(git('ls-files -z', env=env))
+            for path in deleted:
+                i = bisect.bisect_left(indexed, path)
+                while i < len(indexed) and indexed[i].startswith(path):
+                    if indexed[i] == path or indexed[i].startswith(path + '/'):
+                        paths.append(indexed[i])
+                    i += 1
+        git.updateIndex(paths, env=env)
+        return git.writeTree(env=env)
+
+    def _commit(self, cs, tree, domain):
+        verbose = self.args.verbose
+        if verbose:
+            print('Committing changeset %s to Git...' % cs.id)
+        commit = git.commitTree(tree, [self._head], self._comment(cs), author=self._author(cs, domain),
+                                date=cs.dateIso)
+        # journal the note first: tfs must never point to a commit without a note
+        changesetIndex.add(commit, cs.id)
+        git.updateRefs([('HEAD', commit, self._head)])
+        self._head = commit
+        self._uncommitted.pop(cs.id, None)
+        print('Commit:', commit[:7])
 
+        if self._step(self._progress, cs):
+            changesetIndex.flush()
 
 if __name__ == '__main__':
     fetch().run()
@@ -8,34 +8,48 @@ class log(Command):
 
     def _initArgParser(self, parser):
         Command._initArgParser(self, parser)
+        parser.add_argument('-c', '--changeset', metavar='N..M',
+            help='show only changesets from N to M. Either end can be omitted, "N" shows a single changeset.')
         parser.add_argument('gitArgs', nargs=argparse.REMAINDER,
             help='Similar to git <since>..<until>. Show only commits between the named two commits.')
 
-    def log(self):
-        gitArgs = ', '.join(map(lambda s: '\'' + s + '\'', self.args.gitArgs))
+    def _changesetRange(self, spec):
+        """Translates a changeset range to git log arguments."""
+        first, sep, last = spec.partition('..')
+        if not sep:
+            last = first
+        try:
+            first = int(first) if first else 0
+            last = int(last) if last else None
+        except ValueError:
+            fail('Malformed changeset range: ' + spec)
+
+        commits = changesetIndex.commitRange(first, last)
+        if not commits:
+            fail('There are no fetched changesets in range ' + spec)
+        oldest, newest = commits
+        return '%s --not %s^@' % (newest, oldest)
 
-        endMarker = '</git.tf>'
-        process = git.start('log {} --first-parent --format="%h\t%an\t%at\t%s%n%N%n{}"'.format(gitArgs, endMarker))
-        for line in iter(process.readline, None):
-            (commit, author, date, comment) = line.split('\t', 3)
+    def log(self):
+        gitArgs = ' '.join(map(shlex.quote, self.args.gitArgs))
+        if self.args.changeset:
+            gitArgs = self._changesetRange(self.args.changeset) + ' ' + gitArgs
+
+        # commits are NUL-terminated, changeset numbers come from the notes index rather than %N
+        records = git.stream('log -z --first-parent --format=%H%x09%h%x09%an%x09%at%x09%s ' + gitArgs,
+                             separator=b'\0')
+        maxLen = terminalSize().columns
+        for record in records:
+            (commit, shortCommit, author, date, comment) = record.split('\t', 4)
             date = datetime.datetime.fromtimestamp(int(date)).strftime('%x %X')
+            changeset = changesetIndex.changeset(commit)
 
-            changeset = None
-            for line in iter(process.readline, endMarker):
-                if not changeset:
-                    changeset = line.split(' ', 1)[0]
-
-            comment = comment.replace('\n', ' ')
-            line = '{:<7} {:<15} {:<23} {}'.format(changeset or commit, author, date, comment)
-            maxLen = terminalWidth
+            line = '{:<7} {:<15} {:<23} {}'.format(changeset or shortCommit, author, date, comment)
             if len(line) > maxLen:
                 line = line[:maxLen - 3] + '...'
 
             yield line
 
-        if process.exitCode:
-            process.fail()
-
     def _run(self):
         printLess(self.log())
 
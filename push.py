@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 from core import *
+from concurrent.futures import ThreadPoolExecutor
 import shutil
 import re
 import repair
@@ -15,6 +16,10 @@ class push(Command):
         parser.addNoChecks()
         parser.addDryRun()
         parser.addNumber('maximum number of changesets to push')
+        parser.add_argument('--renameLimit', type=int, default=config.getInt('tf.push.renameLimit'), metavar='N',
+            help='look for copies only among modified files and check at most N files for renames. '
+                 'By default copies are searched among all files, which is slow on big trees. '
+                 'Defaults to tf.push.renameLimit config value')
 
     def __enter__(self):
         self.moveToRootDir()
@@ -25,73 +30,90 @@ class push(Command):
         dryRun = self.args.dryRun
         verbose = self.args.verbose
 
-        git('checkout ' + hash)
-
         if verbose:
             print()
             printLine()
-        print('Pushing [%d/%d] %s...' % (index + 1, total, git(r'log -1 --format="%h \"%s\""')))
+        print('Pushing [%d/%d] %s...' % (index + 1, total, git(r'log -1 --format="%h \"%s\"" ' + hash)))
 
-        def rawDiff(changeType):
-            return git('diff --raw --find-copies-harder HEAD^.. --diff-filter=%s' % changeType)
+        allChanges = self._changes[hash]
 
-        def readChanges(changeType, displayChangeType):
-            changes = [change[change.index('\t'):].strip().split('\t') for change in rawDiff(changeType).splitlines()]
+        def readChanges(kinds, displayChangeType):
+            changes = [c for c in allChanges if c.kind in kinds]
             if changes:
                 if verbose:
                     print(displayChangeType + ':')
-                    printIndented([' -> '.join(f) for f in changes])
+                    printIndented([str(c) for c in changes])
                 yield changes
 
         def joinFiles(files):
             return '"' + '" "'.join(files) + '"'
 
         def joinChanges(changes):
-            return ' '.join(map(joinFiles, changes))
+            return ' '.join(joinFiles(c.paths) for c in changes)
 
-        unknownChanges = rawDiff('TUX')
+        unknownChanges = [str(c) for c in allChanges if c.kind == 'unknown']
         if unknownChanges:
             print('Unexpected file change!!')
             print()
             printIndented(unknownChanges)
             fail()
 
+        # pend operations are collected and run by a single tf process
+        pending = []
+
         def tfmut(*args):
-            tf(args, dryRun=dryRun)
+            pending.append(args)
+
+        def missingDir(path):
+            """Returns the topmost missing folder of a path."""
+            missing = None
+            while path and not os.path.exists(path):
+                missing, path = path, os.path.dirname(path)
+            return missing
 
         try:
-            for c in readChanges('D', 'Removed'):
+            if not dryRun:
+                self._materialize(allChanges)
+            for c in readChanges(['delete'], 'Removed'):
                 tfmut('rm -recursive {}', joinChanges(c))
-            for c in readChanges('M', 'Modified'):
+            for c in readChanges(['modify'], 'Modified'):
                 tfmut('checkout {}', joinChanges(c))
-            for changes in readChanges('R', 'Renamed'):
-                for files in changes:
-                    src, dest = files
-                    destDir = createDestDir = None
-                    try:
+
+            # tf renames files itself, so they are moved back to their old paths first
+            renames = []
+            createdDirs = []
+            try:
+                for changes in readChanges(['rename'], 'Renamed'):
+                    for change in changes:
+                        src, dest = change.paths
                         if not dryRun:
-                            destDir = os.path.dirname(src)
-                            createDestDir = not os.path.exists(destDir)
-                            if createDestDir:
-                                mkdir(destDir, True)
+                            srcDir = missingDir(os.path.dirname(src))
+                            if srcDir:
+                                mkdir(os.path.dirname(src), True)
+                                createdDirs.append(srcDir)
                             os.rename(dest, src)
-                        try:
-                            tfmut('rename {}', joinFiles(files))
-                            tfmut('checkout {}', files[1])
-                        except:
-                            if not dryRun:
-                                os.rename(src, dest)
-                            raise
-                    finally:
-                        if createDestDir:
-                            shutil.rmtree(destDir)
-            for c in readChanges('CA', 'Added'):
-                tfmut('add {}', joinChanges([files[-1:] for files in c]))
+                            renames.append((src, dest))
+                        tfmut('rename {}', joinFiles(change.paths))
+                        tfmut('checkout {}', joinFiles([dest]))
+                for c in readChanges(['copy', 'add'], 'Added'):
+                    tfmut('add {}', joinFiles([change.path for change in c]))
+
+                tf.runAll(pending, dryRun=dryRun)
+            except:
+                # move back files that tf has not renamed
+                for src, dest in renames:
+                    if os.path.exists(src) and not os.path.exists(dest):
+                        os.rename(src, dest)
+                raise
+            finally:
+                for d in createdDirs:
+                    if os.path.isdir(d):
+                        shutil.rmtree(d)
 
             if verbose:
                 print('Checking in...')
-            comment = git('log -1 --format=%s%n%b').strip()
-            workitems = git('notes --ref=%s show %s' % (wi.noteNamespace, hash), errorValue='')
+            comment = git('log -1 --format=%s%n%b ' + hash).strip()
+            workitems = self._workitems.get(hash, '')
             if workitems:
                 workitems = '"-associate:%s"' % workitems
             with tempfile.NamedTemporaryFile('w') as tempFile:
@@ -109,17 +131,92 @@ class push(Command):
                 print('Changeset number:', changeSetNumber)
         except:
             if not dryRun:
-                repairer = repair.repair()
-                repairer.checkoutBranch = 'tfs'
-                repairer._run()
+                self._rollback(allChanges)
             raise
 
-        # add a note about the changeset number
+        # the note is journaled before tfs moves, so a killed push does not lose it
         if verbose:
-            print('Moving tfs branch HEAD and marking the commit with a "tf" note')
-        git('checkout tfs', dryRun=dryRun)
-        git('merge --ff-only %s' % hash, dryRun=dryRun)
-        git('notes add -m "%s" %s' % (changeSetNumber, hash), dryRun=dryRun)
+            print('Marking the commit with a "tf" note')
+        if not dryRun:
+            changesetIndex.add(hash, changeSetNumber)
+            self._moveTfs(hash)
+
+    def _rollback(self, changes):
+        """Undoes pending changes of a commit that failed to be pushed and restores its files from tfs branch.
+
+        Only the paths of the commit are touched. If that fails, the whole workspace is repaired.
+        """
+        paths = set(path for c in changes for path in c.paths)
+        print('Rolling back %d file(s)' % len(paths))
+        try:
+            if paths:
+                tf.runAll([('undo {}', ' '.join('"%s"' % p for p in sorted(paths)))], allowedExitCodes=[0, 1, 100],
+                          output=self.args.verbose)
+            git.restore(paths)
+            return
+        except GitTfException:
+            print('Could not roll back only these files')
+
+        repairer = repair.repair()
+        repairer.args = self.args
+        repairer.checkoutBranch = 'tfs'
+        repairer._run()
+        # drop files added by the commit that failed
+        git('reset -q --hard')
+
+    def _materialize(self, changes):
+        """Makes the index and the worktree match a commit, touching only the paths it changed.
+
+        The commit must be a child of HEAD, which is tfs branch. _moveTfs moves it once the commit is checked in.
+        """
+        removed = [c.paths[0] for c in changes if c.kind in ('delete', 'rename')]
+        written = [c for c in changes if c.kind != 'delete']
+        if not changes:
+            return
+        info = ['%s %s\t%s\0' % (c.mode, c.hash, c.path) for c in written]
+        info += ['0 %s\t%s\0' % ('0' * len(changes[0].hash), path) for path in removed]
+        git('update-index -z --index-info', input=''.join(info))
+
+        for path in removed:
+            if os.path.lexists(path):
+                removePath(path)
+        if written:
+            git('checkout-index -f -z --stdin', input=''.join(c.path + '\0' for c in written))
+
+    def _moveTfs(self, commit):
+        """Moves tfs branch, which is checked out, to a pushed commit. The index already matches it."""
+        if self.args.verbose:
+            print('Moving tfs branch HEAD')
+        git.updateRefs([('refs/heads/tfs', commit, self._tfs)])
+        self._tfs = commit
+
+    def _preflight(self, lastCommit, commits):
+        """Checks TFS state while the changes and work items of the commits are read from git.
+
+        TFS queries do not depend on each other, so they run concurrently.
+        """
+        print('Checking TFS status and whether there are no unfetched changes on TFS...')
+        stages = Stages()
+        with ThreadPoolExecutor(2) as pool:
+            tfsDirty = None if self.args.noChecks else pool.submit(stages.run, 'tf status', tf.hasPendingChanges)
+            theirLatestChangeset = pool.submit(stages.run, 'tf history', tf.latestChangesetId)
+
+            with stages.stage('git diff'):
+                self._changes = {hash: git.diffChanges('%s^ %s' % (hash, hash), self.args.renameLimit)
+                                 for hash in commits}
+            with stages.stage('work items'):
+                self._workitems = wi.workitems(commits)
+            ourLatestChangeset = git.getChangesetNumber(lastCommit, fail=True)
+
+            if tfsDirty and tfsDirty.result():
+                fail('TFS status is dirty!')
+            theirLatestChangeset = theirLatestChangeset.result()
+        if int(ourLatestChangeset) < int(theirLatestChangeset):
+            print('There are unfetched changes on TFS. Fetch and merge them before pushing')
+            print('Latest local changeset:', ourLatestChangeset)
+            print('Latest TFS changeset:', theirLatestChangeset)
+            fail()
+        print('Preflight:', stages)
 
     def _run(self):
         print('Pushing to TFS')
@@ -134,24 +231,29 @@ class push(Command):
         if self.args.verbose:
             print('Last synchronized commit:', git('log -1 --format=%h tfs'))
         commits = git('log %s.. --format=%%H master --reverse --first-parent' % lastCommit).splitlines()
+        # a push killed after a check-in may leave tfs behind commits that have notes already
+        pushed = list(takewhile(changesetIndex.changeset, commits))
+        if pushed and not self.args.dryRun:
+            print('Moving tfs branch over %d already pushed commit(s)' % len(pushed))
+            git.updateRefs([('refs/heads/tfs', pushed[-1], lastCommit)])
+            git('reset -q --hard')
+            lastCommit = pushed[-1]
+            commits = commits[len(pushed):]
         commits = commits[:self.args.number]
         if not commits:
             print('Nothing to push')
             return
 
-        print('Checking whether there are no unfetched changes on TFS...')
-        ourLatestChangeset = git.getChangesetNumber(lastCommit, fail=True)
-        theirLatestChangeset = tf.history(stopAfter=1)[0].id
-        if int(ourLatestChangeset) < int(theirLatestChangeset):
-            print('There are unfetched changes on TFS. Fetch and merge them before pushing')
-            print('Latest local changeset:', ourLatestChangeset)
-            print('Latest TFS changeset:', theirLatestChangeset)
-            fail()
+        self._preflight(lastCommit, commits)
 
         print('%d commit(s) to be pushed:' % len(commits))
 
-        for i, hash in enumerate(commits):
-            self._push(hash, i, len(commits))
+        self._tfs = lastCommit
+        try:
+            for i, hash in enumerate(commits):
+                self._push(hash, i, len(commits))
+        finally:
+            changesetIndex.flush()
 
 
 if __name__ == '__main__':
@@ -17,13 +17,26 @@ class repair(Command):
 
     def _run(self):
         print('Restoring Git and TFS state...')
-        if not tf.hasPendingChanges():
+        changes = tf.pendingChanges()
+        if not changes:
             print('It\'s OK')
             return
-        with ReadOnlyWorktree():
-            print('Clearing TFS pending changes...')
-            tf('undo -recursive .', allowedExitCodes=[0, 100])
-        git('checkout -f ' + self.checkoutBranch)
+
+        paths = sorted(set(path for change in changes for path in change.paths))
+        if self.args.verbose:
+            printIndented(['%s: %s' % (change.changeType, ' -> '.join(change.paths)) for change in changes])
+        print('Clearing %d TFS pending change(s)...' % len(changes))
+        # only the files tf touches need to be read-only, as in ReadOnlyWorktree
+        setWritable([p for p in paths if os.path.isfile(p)], False)
+        try:
+            tf.runForPaths('undo', [change.path for change in changes], allowedExitCodes=[0, 1, 100])
+        finally:
+            setWritable([p for p in paths if os.path.isfile(p)], True)
+
+        if git('symbolic-ref -q --short HEAD', errorValue='') != self.checkoutBranch:
+            git('checkout -f ' + self.checkoutBranch)
+        # files added in TFS but not in git are kept, as they may be new files of the user
+        git.restore(paths, removeUntracked=False)
 
 
 if __name__ == '__main__':
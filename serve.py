@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+from core import *
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import importlib
+import traceback
+import json
+import signal
+import io
+
+gitTfPath = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'git-tf')
+
+
+class Workspace(object):
+    """A mapped folder kept in sync by serve, with its schedule and metrics."""
+
+    def __init__(self, folder, interval):
+        self.folder = os.path.abspath(folder)
+        self.interval = interval
+        self.worker = PersistentProcess([sys.executable, gitTfPath, 'serve', '--worker'], cwd=self.folder)
+        self.nextPoll = 0
+        self.state = 'idle'
+        self.lastChangeset = None
+        self.latestChangeset = None
+        self.lastPoll = None
+        self.pollLatency = None
+        self.lastFetch = None
+        self.fetchDuration = None
+        self.fetches = 0
+        self.rounds = 0
+        self.failures = 0
+        self.error = None
+
+    def status(self):
+        timestamp = lambda t: t and datetime.datetime.fromtimestamp(t).isoformat(timespec='seconds')
+        return {
+            'folder': self.folder,
+            'state': self.state,
+            'lastChangeset': self.lastChangeset,
+            'latestChangeset': self.latestChangeset,
+            'lastPoll': timestamp(self.lastPoll),
+            'pollLatency': self.pollLatency,
+            'lastFetch': timestamp(self.lastFetch),
+            'fetchDuration': self.fetchDuration,
+            'fetches': self.fetches,
+            'failures': self.failures,
+            'error': self.error,
+            'nextPoll': timestamp(self.nextPoll),
+        }
+
+
+class serve(Command):
+    """Keep mapped folders in sync with TFS: poll TFS history and fetch new changesets."""
+
+    def _initArgParser(self, parser):
+        parser.addVerbose()
+        parser.add_argument('folders', nargs='*',
+            help='mapped folders with git-tf repositories. Defaults to the current folder')
+        parser.add_argument('-i', '--interval', type=float, default=config.getInt('tf.serve.interval', 60),
+            help='seconds between TFS polls. Defaults to tf.serve.interval config value or 60')
+        parser.add_argument('--maxInterval', type=float, default=900,
+            help='longest poll interval in seconds. The interval doubles while there are no changes or tf fails')
+        parser.add_argument('-j', '--jobs', type=int, default=4,
+            help='maximum number of folders synchronized at the same time')
+        parser.add_argument('--statusFile', default='git-tf-serve.json',
+            help='JSON file with the state and latency of every folder, rewritten after each poll')
+        parser.add_argument('--pull', action='store_true',
+            help='pull instead of fetch')
+        parser.add_argument('--once', action='store_true',
+            help='synchronize every folder once and exit')
+        parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+
+    def __enter__(self):
+        pass
+
+    def runWithArgs(self, args):
+        if args.worker:
+            self._work()
+        else:
+            Command.runWithArgs(self, args)
+
+    def _work(self):
+        """Answers requests of serve in one folder: a line with poll, fetch or pull.
+
+        Each answer is a JSON line. The process stays alive between requests, so modules, config values,
+        the changeset index and git batch processes are loaded only once. Config values are read again
+        after a failed request.
+        """
+        out = sys.stdout
+        try:
+            for request in iter(sys.stdin.readline, ''):
+                output = io.StringIO()
+                with contextlib.redirect_stdout(output):
+                    response = self._handle(request.strip())
+                if response['exitCode']:
+                    # the user may fix the config before the retry
+                    config.invalidate()
+                response['output'] = output.getvalue()
+                out.write(json.dumps(response) + '\n')
+                out.flush()
+        except KeyboardInterrupt:
+            # serve is stopping, a running fetch has rolled back
+            pass
+
+    def _handle(self, request):
+        response = {'exitCode': 0}
+        try:
+            changesetIndex.refresh()
+            if request == 'poll':
+                response['latestChangeset'] = tf.latestChangesetId()
+            else:
+                command = getattr(importlib.import_module(request), request)()
+                parser = ArgParser()
+                command.initArgParser(parser)
+                command.runWithArgs(parser.parse_args([]))
+        except SystemExit as e:
+            response['exitCode'] = e.code
+        except GitTfException:
+            response['exitCode'] = 1
+        except Exception:
+            traceback.print_exc(file=sys.stdout)
+            response['exitCode'] = 1
+        # a failed fetch may have committed some changesets
+        response['lastChangeset'] = git.getChangesetNumber('tfs')
+        return response
+
+    def _request(self, ws, request):
+        """Sends a request to the worker of a folder. Returns the response or fails with its error."""
+        ws.worker.write(request + '\n')
+        response = json.loads(ws.worker.readline())
+        if self.args.verbose:
+            printIndented(response['output'])
+        if response['exitCode']:
+            # the error and the failed command, without the indented output of the rollback
+            lines = [l for l in response['output'].splitlines()
+                     if l.strip() and not l.startswith((' ', 'Rolling back'))]
+            raise GitTfException(' | '.join(lines[-2:]) or '%s exited with code %s' % (request, response['exitCode']))
+        return response
+
+    def _sync(self, ws):
+        """Polls TFS for a folder and fetches if there are new changesets."""
+        ws.state = 'polling'
+        started = time.time()
+        try:
+            response = self._request(ws, 'poll')
+            ws.lastChangeset, ws.latestChangeset = response['lastChangeset'], response['latestChangeset']
+            ws.lastPoll = time.time()
+            ws.pollLatency = round(ws.lastPoll - started, 3)
+
+            changed = ws.latestChangeset and ws.latestChangeset != ws.lastChangeset
+            if changed:
+                ws.state = 'fetching'
+                print('%s: fetching %s..%s' % (ws.folder, ws.lastChangeset, ws.latestChangeset))
+                started = time.time()
+                try:
+                    response = self._request(ws, 'pull' if self.args.pull else 'fetch')
+                finally:
+                    ws.lastFetch = time.time()
+                    ws.fetchDuration = round(ws.lastFetch - started, 3)
+                    ws.fetches += 1
+                ws.lastChangeset = response['lastChangeset']
+                print('%s: synchronized changeset %s' % (ws.folder, ws.lastChangeset))
+
+            ws.failures = 0
+            ws.error = None
+            ws.state = 'idle'
+            ws.interval = self.args.interval if changed else min(ws.interval * 2, self.args.maxInterval)
+            ws.nextPoll = time.time() + ws.interval
+        except Exception as e:
+            # tf or git has already printed the details
+            self._failed(ws, str(e) if e.args and e.args[0] else 'Polling TFS failed')
+        finally:
+            ws.rounds += 1
+
+    def _failed(self, ws, error):
+        ws.failures += 1
+        ws.error = error
+        ws.state = 'error'
+        ws.interval = min(self.args.interval * 2 ** ws.failures, self.args.maxInterval)
+        ws.nextPoll = time.time() + ws.interval
+        print('%s: %s. Retrying in %d s' % (ws.folder, error, ws.interval))
+
+    def _writeStatus(self, workspaces):
+        path = self.args.statusFile
+        with open(path + '.tmp', 'w') as f:
+            json.dump({
+                'updated': datetime.datetime.now().isoformat(timespec='seconds'),
+                'workspaces': [ws.status() for ws in workspaces],
+            }, f, indent=2)
+        os.replace(path + '.tmp', path)
+
+    def _run(self):
+        folders = self.args.folders or ['.']
+        workspaces = [Workspace(folder, self.args.interval) for folder in folders]
+        for ws in workspaces:
+            if not os.path.isdir(os.path.join(ws.folder, '.git')):
+                fail('Not a git-tf repository: ' + ws.folder)
+
+        print('Synchronizing %d folder(s) with TFS. Status file: %s' % (len(workspaces),
+                                                                           os.path.abspath(self.args.statusFile)))
+        def stop(*_):
+            raise KeyboardInterrupt()
+        signal.signal(signal.SIGTERM, stop)
+
+        pool = ThreadPoolExecutor(self.args.jobs)
+        running = {}
+        try:
+            while True:
+                now = time.time()
+                for ws in workspaces:
+                    if ws not in running and ws.nextPoll <= now and not (self.args.once and ws.rounds):
+                        running[ws] = pool.submit(self._sync, ws)
+                if self.args.once and not running:
+                    break
+
+                waiting = [ws.nextPoll for ws in workspaces if ws not in running]
+                timeout = max(min(waiting) - now, 0.1) if waiting else None
+                if not running:
+                    time.sleep(timeout)
+                    continue
+                done, _ = wait(running.values(), timeout=timeout, return_when=FIRST_COMPLETED)
+                for ws, future in list(running.items()):
+                    if future in done:
+                        del running[ws]
+                        future.result()
+                self._writeStatus(workspaces)
+        except KeyboardInterrupt:
+            print('Stopping. Waiting for running fetches to roll back...')
+        finally:
+            pool.shutdown()
+            for ws in workspaces:
+                ws.worker.close()
+            self._writeStatus(workspaces)
+
+
+if __name__ == '__main__':
+    serve().run()
@@ -1,16 +1,66 @@
 #!/usr/bin/env python3
 from core import *
+import json
 
 
 class status(Command):
     """Display commits to be pushed to TFS."""
+    cacheFile = 'tf-status'
+
+    def _initArgParser(self, parser):
+        output = parser.add_mutually_exclusive_group()
+        output.add_argument('--porcelain', action='store_true',
+            help='print "name value" lines that are easy to parse: branch, changeset, ahead')
+        output.add_argument('--json', action='store_true',
+            help='print a JSON object with the same values as --porcelain')
 
     def __enter__(self):
-        self.moveToRootDir()
-        self.switchBranch('master')
+        pass
+
+    def summary(self):
+        """Returns the current branch, the last synchronized changeset and the number of commits to push.
+
+        It does not list commits, and the result is cached while tfs, master and tf notes stay the same.
+        """
+        refs = dict(line.split() for line in git('for-each-ref "--format=%(refname) %(objectname)" '
+                                                 'refs/heads/tfs refs/heads/master ' + changesetIndex.ref).splitlines())
+        if 'refs/heads/tfs' not in refs or 'refs/heads/master' not in refs:
+            fail('tfs or master branch is missing. Is it a git-tf repository?')
+        tfsHash = refs['refs/heads/tfs']
+        key = ' '.join(refs.get(ref, '') for ref in ('refs/heads/tfs', 'refs/heads/master', changesetIndex.ref))
+
+        summary = None
+        cachePath = git.gitPath(self.cacheFile)
+        try:
+            with open(cachePath) as f:
+                cached = json.load(f)
+            if cached.pop('key') == key:
+                summary = cached
+        except (IOError, ValueError, KeyError):
+            pass
+
+        if summary is None:
+            summary = {
+                'changeset': int(changesetIndex.changeset(tfsHash) or 0) or None,
+                'ahead': int(git('rev-list --count --first-parent tfs..master')),
+            }
+            with open(cachePath, 'w') as f:
+                json.dump(dict(summary, key=key), f)
+
+        summary['branch'] = git('symbolic-ref -q --short HEAD', errorValue='') or None
+        return summary
 
     def _run(self):
-        commits = git('log tfs.. --format="%h %s" --first-parent').splitlines()
+        if self.args.porcelain or self.args.json:
+            summary = self.summary()
+            if self.args.json:
+                print(json.dumps(summary, sort_keys=True))
+            else:
+                for name in ['branch', 'changeset', 'ahead']:
+                    print(name, summary[name] if summary[name] is not None else '')
+            return
+
+        commits = git('log tfs..master --format="%h %s" --first-parent').splitlines()
         if not commits:
             print('There are no commits to be pushed to TFS')
             return
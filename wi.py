@@ -4,8 +4,61 @@ from core import *
 noteNamespace = 'tf.wi'
 
 
+class WorkItemIndex(NotesIndex):
+    """Work items of commits and commits of work items, built from the tf.wi notes."""
+    ref = 'refs/notes/' + noteNamespace
+    cacheFile = 'tf-wi-index'
+    noteName = 'work item'
+    flushMessage = 'Work items updated by git-tf'
+
+    def _parse(self, text):
+        return re.findall(r'\d+', text)
+
+    def _format(self, items):
+        return ','.join(items) or None
+
+    def _set(self, commit, items):
+        for item in self._values.pop(commit, []):
+            self._commits[item].remove(commit)
+            if not self._commits[item]:
+                del self._commits[item]
+        if items:
+            self._values[commit] = items
+            for item in items:
+                self._commits.setdefault(item, []).append(commit)
+
+    def _clear(self):
+        self._values = {}
+        self._commits = {}
+
+    def workitems(self, commit):
+        """Returns the work item IDs (strings) associated with a commit hash."""
+        self._ensureLoaded()
+        return list(self._values.get(commit, []))
+
+    def commits(self, workitem):
+        """Returns the hashes of the commits associated with a work item."""
+        self._ensureLoaded()
+        return list(self._commits.get(str(workitem), []))
+
+    def set(self, commit, items):
+        """Replaces the work items of a commit hash. The note is written by flush()."""
+        self._ensureLoaded()
+        items = [str(item) for item in items if item]
+        if items != self._values.get(commit, []):
+            self._put(commit, items)
+
+workItemIndex = WorkItemIndex()
+
+
+def workitems(commits):
+    """Returns a dict of associated work items of the commits that have any."""
+    found = {commit: ','.join(workItemIndex.workitems(commit)) for commit in commits}
+    return {commit: items for commit, items in found.items() if items}
+
+
 class wi(Command):
-    """Associate a commit with a TFS workitem."""
+    """Associate commits with TFS workitems."""
 
     def argParserCtorArgs(self):
         args = Command.argParserCtorArgs(self)
@@ -26,52 +79,77 @@ Remove workitem 123 association:
 
 Remove all workitem associations:
     $ git tf wi -d
+
+Associate workitem 789 with all commits to be pushed, in one notes commit:
+    $ git tf wi -r tfs..master 789
+
+Show commits associated with workitem 789:
+    $ git tf wi -f 789
         """
         return args
 
     def _initArgParser(self, parser):
         parser.addVerbose()
-        parser.add_argument('-c', '--commit', default='HEAD',
+        target = parser.add_mutually_exclusive_group()
+        target.add_argument('-c', '--commit', default='HEAD',
             help='commit to associate with. Defaults to HEAD.')
+        target.add_argument('-r', '--range', metavar='REVISIONS',
+            help='associate, remove or show workitems of all commits in a revision range, e.g. tfs..master')
+        target.add_argument('-f', '--find', action='store_true',
+            help='show commits associated with the workitems')
 
         parser.add_argument('-d', '--delete', action='store_true',
             help='Remove work item association.')
-        parser.add_argument('workitem', type=int, nargs='?',
-            help='Workitem ID')
+        parser.add_argument('workitem', type=int, nargs='*',
+            help='Workitem IDs')
 
-    def _run(self):
+    def _commits(self):
         args = self.args
+        if args.range:
+            commits = git('rev-list --reverse %s' % args.range, errorValue='').splitlines()
+            if not commits:
+                fail('There are no commits in %s' % args.range)
+            return commits
+        commit = git.resolve(args.commit)
+        if not commit:
+            fail('Unknown commit %s' % args.commit)
+        return [commit]
+
+    def _find(self):
+        commits = []
+        for workitem in self.args.workitem:
+            commits += [c for c in workItemIndex.commits(workitem) if c not in commits]
+        if commits:
+            print(git('log --no-walk --format="%h %s" ' + ' '.join(commits)))
 
-        def notes(noteArgs, **kwargs):
-            gitArgs = 'notes --ref=%s %s %s' % (noteNamespace, noteArgs, args.commit)
-            return git(gitArgs, **kwargs)
-
-        def add(note):
-            notes('add -fm "%s"' % note)
-
-        note = notes('show', errorValue='')
-
-        if args.delete:
-            if not note:
-                return
-            workitem = args.workitem
-            if workitem:
-                items = note.split(',')
-                try:
-                    items.remove(str(workitem))
-                except ValueError:
-                    fail('Workitem %s is not associated with %s' % (workitem, args.commit))
-                if items:
-                    add(','.join(items))
-                    return
-            notes('remove')
-
-        elif args.workitem:
-            if note:
-                note += ','
-            add(note + str(args.workitem))
-        elif note:
-            print(note)
+    def _run(self):
+        args = self.args
+        workitems = [str(w) for w in args.workitem]
+        if args.find:
+            if not workitems:
+                fail('Specify workitems to find')
+            self._find()
+            return
+
+        commits = self._commits()
+        try:
+            for commit in commits:
+                items = workItemIndex.workitems(commit)
+                if args.delete:
+                    if workitems and not args.range:
+                        missing = [w for w in workitems if w not in items]
+                        if missing:
+                            fail('Workitem %s is not associated with %s' % (','.join(missing), args.commit))
+                    workItemIndex.set(commit, [w for w in items if workitems and w not in workitems])
+                elif workitems:
+                    workItemIndex.set(commit, items + [w for w in workitems if w not in items])
+                elif items:
+                    if args.range:
+                        print(commit[:7], ','.join(items))
+                    else:
+                        print(','.join(items))
+        finally:
+            workItemIndex.flush()
 
 
 if __name__ == '__main__':